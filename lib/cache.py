@@ -0,0 +1,136 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+
+def link_or_copy(src_path, dest_path):
+    """
+    Make a file available at another path without copying it if possible
+    (as a hard link), or as a copy if the paths are on different devices.
+    A hard link shares its contents with the original, so the file must
+    never be modified in place afterwards.
+
+    :param src_path: path to an existing file
+    :param dest_path: path to make it available at
+    """
+    if os.path.exists(dest_path):
+        os.remove(dest_path)
+    try:
+        os.link(src_path, dest_path)
+    except OSError:
+        shutil.copyfile(src_path, dest_path)
+
+
+class FileCache:
+    """
+    A local cache of downloaded files (eg. the SQL dump and the raw data
+    zips) that persists between runs, so that a file that hasn't changed
+    since the last time it was downloaded on this host doesn't have to be
+    downloaded again.
+
+    Files are stored under a hash of their name and their version, which
+    is anything that changes whenever the contents do (eg. an S3 ETag, or
+    the size and modification time on the SFTP). When the cache grows past
+    max_bytes, the least recently used files are removed.
+
+    It's safe to use from several threads at once.
+    """
+
+    def __init__(self, cache_dir, max_bytes=20 * 1024 ** 3):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+
+    def path(self, name, version):
+        """ path of the cached file for a version of a file """
+        digest = hashlib.sha256(f"{name}\n{version}".encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, f"{digest[:32]}-{os.path.basename(name)}")
+
+
+    def get(self, name, version):
+        """
+        Get the path of a cached file, marking it as recently used, or None
+        if that version of the file isn't in the cache
+        """
+        path = self.path(name, version)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+
+    def fetch(self, name, version, download):
+        """
+        Get the path of a cached file, downloading it into the cache first
+        if that version isn't there yet. The download goes to a temporary
+        directory in the cache and is only moved into place once it's done.
+
+        :param name: name of the file (eg. S3 object name)
+        :param version: version of the file (eg. S3 ETag)
+        :param download: function that downloads the file to the path it's
+            given
+        :return: path to the cached file, and whether it was already cached
+        """
+        path = self.get(name, version)
+        if path is not None:
+            return path, True
+
+        path = self.path(name, version)
+        tmp_dir = tempfile.mkdtemp(prefix='.download-', dir=self.cache_dir)
+        try:
+            tmp_path = os.path.join(tmp_dir, os.path.basename(name))
+            download(tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.evict(keep=path)
+        return path, False
+
+
+    def put(self, name, version, file_path):
+        """
+        Add a local file to the cache (eg. a file that was just uploaded,
+        with the version it got), linking it rather than copying it if
+        possible
+
+        :param name: name of the file (eg. S3 object name)
+        :param version: version of the file (eg. S3 ETag)
+        :param file_path: path to the local file
+        """
+        path = self.path(name, version)
+        tmp_path = os.path.join(self.cache_dir, '.put-' + os.path.basename(path))
+        link_or_copy(file_path, tmp_path)
+        os.replace(tmp_path, path)
+        self.evict(keep=path)
+
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used files until the cache fits in
+        max_bytes. The file given in keep is never removed, even if it's
+        bigger than that on its own.
+        """
+        with self.lock:
+            files = []
+            for entry in os.scandir(self.cache_dir):
+                # Skip downloads in progress and anything else that isn't a cached file
+                if entry.name.startswith('.') or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+
+            total = sum(size for mtime, size, path in files)
+            for mtime, size, path in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if path == keep:
+                    continue
+                print(f"- Removing {os.path.basename(path)} from the cache")
+                os.remove(path)
+                total -= size
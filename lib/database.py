@@ -1,66 +1,452 @@
 import urllib.parse
 import psycopg2
-import psycopg2.extras
+import collections
+import io
 import os
+import re
+import subprocess
+import tarfile
+import tempfile
+import time
 
 
-# https://github.com/nycdb/nycdb/blob/master/src/nycdb/sql.py
-def insert_many(table_name, rows):
+# Characters that have to be backslash-escaped in the text format of COPY
+COPY_ESCAPES = str.maketrans({
+    '\\': '\\\\',
+    '\t': '\\t',
+    '\n': '\\n',
+    '\r': '\\r',
+})
+
+
+# The reverse of COPY_ESCAPES, for reading back rows formatted for COPY
+COPY_UNESCAPES = {
+    '\\': '\\',
+    't': '\t',
+    'n': '\n',
+    'r': '\r',
+}
+COPY_ESCAPE_PAT = re.compile(r'\\(.)')
+
+
+def array_literal(values):
+    '''
+    Given a list of values, generate a postgres array literal string,
+    quoting every element so that commas, braces and quotes in the
+    values are preserved.
+    For example:
+        >>> array_literal(['foo', 'b"ar', None])
+        '{"foo","b\\\\"ar",NULL}'
+    '''
+    items = []
+    for value in values:
+        if value is None:
+            items.append('NULL')
+        else:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+            items.append(f'"{value}"')
+
+    return '{' + ','.join(items) + '}'
+
+
+def copy_value(value):
+    '''
+    Format a single value for the text format of COPY ... FROM STDIN [1].
+    None becomes NULL (\\N), lists become postgres arrays and everything
+    else is converted to a string, with special characters escaped.
+    [1]: https://www.postgresql.org/docs/current/sql-copy.html
+    '''
+    if value is None:
+        return '\\N'
+    elif isinstance(value, bool):
+        value = 't' if value else 'f'
+    elif isinstance(value, (list, tuple)):
+        value = array_literal(value)
+    else:
+        value = str(value)
+
+    return value.translate(COPY_ESCAPES)
+
+
+def copy_text_rows(text):
     '''
-    Given a table name and a list of dictionaries representing
-    rows, generate a (sql, template) tuple of strings that can be
-    passed to psycopg2.extras.execute_values() [1] to bulk insert all the
-    values for improved efficiency [2].
+    Given rows formatted for the text format of COPY by copy_value, 
+    generate the lists of their values again, with None for NULL (arrays 
+    are left as postgres array literals).
     For example:
-        >>> insert_many('boop', [{'foo': 1, 'bar': 2}])
-        ('INSERT INTO boop (foo, bar) VALUES %s', '(%(foo)s, %(bar)s)')
-    [1]: http://initd.org/psycopg/docs/extras.html#psycopg2.extras.execute_values
-    [2]: https://stackoverflow.com/a/30985541
+        >>> list(copy_text_rows('foo\\tb\\\\tar\\t\\\\N\\n'))
+        [['foo', 'b\\tar', None]]
     '''
+    unescape = lambda match: COPY_UNESCAPES[match.group(1)]
+    for line in text.split('\n')[:-1]:
+        yield [
+            None if value == '\\N' else COPY_ESCAPE_PAT.sub(unescape, value) if '\\' in value else value
+            for value in line.split('\t')
+        ]
+
+
+class CopyWriter:
+    """Buffers rows for a single table in the text format used by COPY"""
+
+    def __init__(self, table_name, columns):
+        self.table_name = table_name
+        self.columns = list(columns)
+        self.buffer = io.StringIO()
+        self.rows = 0
+        self.marked = (0, 0)
+
+
+    @property
+    def size(self):
+        """ approximate size of the buffered rows in bytes """
+        return self.buffer.tell()
+
+
+    def mark(self):
+        """ remember the current end of the buffer as a safe point to rewind to """
+        self.marked = (self.buffer.tell(), self.rows)
+
+
+    def rewind(self):
+        """ drop every row written since the last call to mark() """
+        position, self.rows = self.marked
+        self.buffer.seek(position)
+        self.buffer.truncate()
+
+
+    def write_rows(self, rows):
+        """ formats a list of dictionaries and adds them to the buffer """
+        columns = self.columns
+        write = self.buffer.write
+        for row in rows:
+            write('\t'.join([copy_value(row[c]) for c in columns]) + '\n')
+        self.rows += len(rows)
+
+
+    def write_text(self, text, rows):
+        """ adds rows that are already formatted for COPY to the buffer """
+        self.buffer.write(text)
+        self.rows += rows
+
+
+    def copy_to(self, curs):
+        """
+        Sends all buffered rows to the table with a single COPY statement
+        and empties the buffer. Returns the number of rows copied.
+        """
+        if not self.rows:
+            return 0
+
+        fields = ', '.join(self.columns)
+        self.buffer.seek(0)
+        curs.copy_expert(f"COPY {self.table_name} ({fields}) FROM STDIN", self.buffer)
+
+        rows = self.rows
+        self.clear()
+        return rows
+
+
+    def clear(self):
+        """ empties the buffer """
+        self.buffer = io.StringIO()
+        self.rows = 0
+        self.marked = (0, 0)
+
+
+class StagingBuffer:
+    """
+    Collects rows for many tables across many cases in memory and loads 
+    them with a single COPY per table (and a single commit) whenever the 
+    row count or byte size threshold is reached
+
+    If a checkpoint function is given, it's called with the number of cases 
+    loaded so far right before every commit, so that it can record them in 
+    the same transaction as their rows.
+    """
+
+    def __init__(self, db, max_rows=100000, max_bytes=64 * 1024 * 1024, checkpoint=None):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.checkpoint = checkpoint
+        self.writers = {}
+        # Total rows loaded into each table so far
+        self.loaded = collections.Counter()
+        # Number of cases whose rows are all in the buffer or loaded
+        self.cases = 0
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        elif issubclass(exc_type, psycopg2.Error):
+            # The transaction is aborted, so nothing more can be loaded
+            self.db.conn.rollback()
+        else:
+            # Keep everything from the cases that were completely parsed
+            for writer in self.writers.values():
+                writer.rewind()
+            self.flush()
+
+
+    @property
+    def rows(self):
+        return sum(w.rows for w in self.writers.values())
+
+
+    @property
+    def size(self):
+        return sum(w.size for w in self.writers.values())
+
+
+    def write_rows(self, rows, table_name):
+        """ adds a list of dictionaries to the buffer for the given table """
+        writer = self.writers.get(table_name)
+        if writer is None:
+            writer = self.writers[table_name] = CopyWriter(table_name, rows[0].keys())
+        writer.write_rows(rows)
+
+
+    def drain(self):
+        """
+        Empties the buffer and returns its contents, already formatted 
+        for COPY, as a list of (table_name, columns, text, rows) tuples
+        """
+        contents = [
+            (w.table_name, w.columns, w.buffer.getvalue(), w.rows) 
+            for w in self.writers.values()
+        ]
+        self.writers = {}
+        return contents
+
+
+    def load(self, contents):
+        """ adds the contents drained from another StagingBuffer """
+        for table_name, columns, text, rows in contents:
+            writer = self.writers.get(table_name)
+            if writer is None:
+                writer = self.writers[table_name] = CopyWriter(table_name, columns)
+            writer.write_text(text, rows)
+
+
+    def end_case(self, cases=1):
+        """
+        Marks the end of all the rows for one case (or for a number of 
+        cases loaded together), so that a case is never split across 
+        transactions, and flushes the buffer if it has grown past either 
+        of the thresholds.
+        """
+        for writer in self.writers.values():
+            writer.mark()
+        self.cases += cases
+
+        if self.rows >= self.max_rows or self.size >= self.max_bytes:
+            self.flush()
 
-    field_names = list(rows[0].keys())
-    fields = ', '.join(field_names)
-    placeholders = ', '.join(["%({})s".format(k) for k in field_names])
-    template = f"({placeholders})"
-    sql = f"INSERT INTO {table_name} ({fields}) VALUES %s"
 
-    return sql, template
+    def flush(self):
+        """ loads all buffered rows into the database and commits """
+        rows = {w.table_name: w.rows for w in self.writers.values()}
+        self.db.copy_writers(self.writers.values())
+        if self.checkpoint is not None:
+            self.checkpoint(self.cases)
+        self.db.commit()
+        self.loaded.update(rows)
+
+
+# Verbose pg_dump/pg_restore messages for when the data for a table starts/finishes
+TABLE_START_PAT = re.compile(r'launching item \d+ TABLE DATA (?:\S+ )?(\S+)|(?:dumping contents of|processing data for) table "(?:[^"]+\.)?([^"]+)"')
+TABLE_END_PAT = re.compile(r'finished item \d+ TABLE DATA (?:\S+ )?(\S+)')
+
+
+def run_timed(args):
+    """
+    Runs pg_dump or pg_restore in verbose mode, printing how long the data 
+    for each table took. Raises an error with the last lines of output if 
+    the command fails.
+
+    :param args: list of command line arguments, including --verbose
+    """
+    started = collections.OrderedDict()
+    finished = {}
+    last_lines = collections.deque(maxlen=20)
+
+    proc = subprocess.Popen(args, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in proc.stderr:
+        last_lines.append(line)
+        now = time.time()
+
+        match = TABLE_START_PAT.search(line)
+        if match:
+            started.setdefault(match.group(1) or match.group(2), now)
+
+        match = TABLE_END_PAT.search(line)
+        if match:
+            finished[match.group(1)] = now
+
+    proc.wait()
+    end = time.time()
+
+    if proc.returncode != 0:
+        print(''.join(last_lines)) # useful for debugging
+        raise subprocess.CalledProcessError(proc.returncode, args[0], stderr=''.join(last_lines))
+
+    # Without parallel jobs there are no "finished" messages, so a table 
+    # lasts until the next one starts
+    starts = list(started.items())
+    for i, (table, start) in enumerate(starts):
+        next_start = starts[i + 1][1] if i + 1 < len(starts) else end
+        print(f"  {table}: {finished.get(table, next_start) - start:.1f}s")
+
+
+def extract_tar(file_path, dest_dir):
+    """
+    Extract a tar file into a directory, refusing any member that isn't a 
+    plain file or directory or that would end up outside the directory 
+    (eg. "../x" or an absolute path), so a tampered dump can't overwrite 
+    other files. Uses the "data" extraction filter where it's available.
+
+    :param file_path: path to the tar file
+    :param dest_dir: directory to extract it into
+    """
+    dest_dir = os.path.realpath(dest_dir)
+
+    with tarfile.open(file_path) as tar:
+        for member in tar.getmembers():
+            path = os.path.realpath(os.path.join(dest_dir, member.name))
+            if not (member.isfile() or member.isdir()) or os.path.commonpath([dest_dir, path]) != dest_dir:
+                raise tarfile.TarError(f"Refusing to extract {member.name} from {file_path}")
+
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(dest_dir, filter='data')
+        else:
+            tar.extractall(dest_dir)
 
 
 # https://github.com/nycdb/nycdb/blob/master/src/nycdb/database.py
 class Database:
     """Database connection to OCA database"""
 
-    def __init__(self, db_url):
+    def __init__(self, db_url, dump_jobs=4):
         self.db_url = db_url
+        self.dump_jobs = dump_jobs
         self.conn = psycopg2.connect(db_url) 
 
 
-    def sql(self, SQL):
+    def use_schema(self, schema):
+        """
+        Creates the schema if it doesn't exist and puts it first on the 
+        search path, so that unqualified tables are created there (eg. a 
+        separate set of staging tables) while the main tables are still 
+        found in public
+        """
+        self.sql(f"CREATE SCHEMA IF NOT EXISTS {schema}; SET search_path TO {schema}, public")
+
+
+    def sql(self, SQL, params=None):
         """ executes single sql statement """
         with self.conn.cursor() as curs:
+            curs.execute(SQL, params)
+        self.conn.commit()
+
+
+    def execute(self, SQL, params=None):
+        """
+        Executes a single sql statement without committing, so that it's 
+        part of the same transaction as what comes next (eg. the rows sent 
+        by copy_writers)
+        """
+        with self.conn.cursor() as curs:
+            curs.execute(SQL, params)
+
+
+    def query(self, SQL, params=None):
+        """ executes a single sql query and returns all the resulting rows """
+        with self.conn.cursor() as curs:
+            curs.execute(SQL, params)
+            rows = curs.fetchall()
+        self.conn.commit()
+        return rows
+
+
+    def fetch_batches(self, SQL, batch_size=100000):
+        """
+        Runs a query with a server-side cursor and yields the resulting 
+        rows in lists of up to batch_size rows, so that huge results never 
+        have to fit in memory all at once
+        """
+        with self.conn.cursor(name='fetch_batches') as curs:
+            curs.itersize = batch_size
             curs.execute(SQL)
+            while True:
+                rows = curs.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+
+
+    def sequence_values(self, sequence, block_size=10000):
+        """
+        Yields new values of a sequence forever, reserving them from the
+        database in blocks of block_size so that ids can be assigned to
+        rows before they're loaded. Values that are reserved but never
+        used just leave a gap, like those of a rolled back insert.
+        """
+        while True:
+            rows = self.query(
+                "SELECT nextval(%s) FROM generate_series(1, %s)",
+                (sequence, block_size)
+            )
+            for row in rows:
+                yield row[0]
+
+
+    def export_snapshot(self):
+        """
+        Starts a repeatable read transaction and exports its snapshot [1], 
+        so that other connections can read exactly the same data with 
+        use_snapshot(). The snapshot stays valid until commit() is called.
+        [1]: https://www.postgresql.org/docs/current/functions-admin.html#FUNCTIONS-SNAPSHOT-SYNCHRONIZATION
+        """
         self.conn.commit()
+        with self.conn.cursor() as curs:
+            curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            curs.execute("SELECT pg_export_snapshot()")
+            return curs.fetchone()[0]
 
 
-    def insert_rows(self, rows, table_name):
+    def use_snapshot(self, snapshot_id):
         """
-        Inserts many rows, all in the same transaction.
+        Starts a repeatable read transaction that sees the same data as the 
+        snapshot exported by another connection, until commit() is called
         """
+        self.conn.commit()
+        with self.conn.cursor() as curs:
+            curs.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+            curs.execute("SET TRANSACTION SNAPSHOT %s", (snapshot_id,))
 
+
+    def copy_writers(self, writers):
+        """
+        Sends the rows buffered in each CopyWriter to its table, all in 
+        the same transaction. This does not commit, so the caller decides 
+        how many rows go into each transaction with commit().
+        """
         with self.conn.cursor() as curs:
-            sql_str, template = insert_many(table_name, rows)
-            try:
-                psycopg2.extras.execute_values(
-                    curs,
-                    sql_str,
-                    rows,
-                    template=template,
-                    page_size=len(rows)
-                )
-            except psycopg2.DataError:
-                print(rows) # useful for debugging
-                raise
+            for writer in writers:
+                try:
+                    writer.copy_to(curs)
+                except psycopg2.DataError:
+                    print(writer.table_name) # useful for debugging
+                    raise
+
+
+    def commit(self):
+        """ commits the current transaction """
         self.conn.commit()
 
 
@@ -80,20 +466,50 @@ class Database:
         
         f = open(file_path, 'w')
 
-        with self.conn.cursor() as curs:
-            curs.copy_expert(f"COPY {table_name} TO STDOUT WITH CSV HEADER", f)
+        self.export_csv_to(table_name, f)
 
         f.close()
 
 
+    def export_csv_to(self, table_name, f):
+        """ 
+        Exports a table as CSV to any writable file-like object (eg. a 
+        compressed stream), which receives bytes unless it's a text file
+        """
+        with self.conn.cursor() as curs:
+            curs.copy_expert(f"COPY {table_name} TO STDOUT WITH CSV HEADER", f)
+
+
     def dump_to(self, file_path):
-        """ pg_dump the database to file """
-        cmd = f"pg_dump {self.db_url} -Fc > {file_path}"
-        os.system(cmd)
+        """ 
+        pg_dump the database in directory format with parallel jobs, then 
+        package the directory into a single (uncompressed, since the table 
+        files are already compressed) tar file 
+        """
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(file_path)) as tmp_dir:
+            dump_dir = os.path.join(tmp_dir, 'oca.dump')
+            run_timed([
+                'pg_dump', '--verbose', '-Fd', '-j', str(self.dump_jobs), 
+                '-f', dump_dir, self.db_url
+            ])
+
+            with tarfile.open(file_path, 'w') as tar:
+                tar.add(dump_dir, arcname='oca.dump')
 
 
     def restore_from(self, file_path):
-        """ pg_restore the database from file """
-        cmd = f"pg_restore -d {self.db_url} -c {file_path}"
-        os.system(cmd)
+        """ 
+        pg_restore the database with parallel jobs, either from a tar file 
+        made by dump_to or from an older single custom format dump file
+        """
+        with tempfile.TemporaryDirectory(dir=os.path.dirname(file_path)) as tmp_dir:
+            if tarfile.is_tarfile(file_path):
+                extract_tar(file_path, tmp_dir)
+                dump_path = os.path.join(tmp_dir, 'oca.dump')
+            else:
+                dump_path = file_path
 
+            run_timed([
+                'pg_restore', '--verbose', '-j', str(self.dump_jobs), 
+                '-c', '--if-exists', '-d', self.db_url, dump_path
+            ])
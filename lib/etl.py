@@ -1,13 +1,31 @@
+import collections
+import datetime
+import functools
+import gzip
+import json
 import os
 import shutil
 import zipfile
 import requests
 import re
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .cache import FileCache, link_or_copy
 from .database import Database
+from .metrics import RunReport
 from .s3 import S3
 from .sftp import Sftp
-from .parsers import parse_file
+from .parsers import DATA_FILENAME, parse_file
+from .splitter import CaseSplitter, case_index_number_id
+from .parquet import export_parquet
+from .pipeline import bounded_map, process_pool, BackgroundQueue
 
 
 OCA_TABLES = [
@@ -26,12 +44,22 @@ OCA_TABLES = [
 
 DATA_ZIPFILE_PAT = r'LandlordTenant\.(Initial\.FiledIn\d{4}|Incr)\.\d{4}-\d{2}-\d{2}\.zip'
 
-DATA_FILENAME = 'LandlordTenantExtract.xml'
-
 S3_PRIVATE_FOLDER = 'private'
 
 S3_PUBLIC_FOLDER = 'public'
 
+S3_DELTAS_FOLDER = 'deltas'
+
+# Database dump made by Database.dump_to, and the older single file format
+DUMP_FILENAME = 'oca.dump.tar'
+LEGACY_DUMP_FILENAME = 'oca.dump'
+
+# File extensions for the compressed CSV export formats
+COMPRESSED_CSV_EXTENSIONS = {
+    'gzip': '.csv.gz',
+    'zstd': '.csv.zst',
+}
+
 
 def make_dir(dir_name):
     """ 
@@ -46,6 +74,26 @@ def make_dir(dir_name):
     return dir_path
 
 
+def order_data_files(files):
+    """
+    Sort data file names in the order in which they need to be processed: 
+    all the Initial files by filing year, then the Incr files by date.
+
+    :param files: list of data file names
+    """
+
+    # It's important that everything is processed in order because files 
+    # can contain modify/delete cases included in past files
+    init_files = [f for f in files if 'Initial' in f]
+    incr_files = [f for f in files if 'Incr' in f]
+
+    files = []
+    files += sorted(init_files) if init_files else []
+    files += sorted(incr_files) if incr_files else []
+
+    return files
+
+
 def list_new_data_files(sftp, s3):
     """ 
     Get a list of filenames for all the data files available in the SFTP
@@ -61,19 +109,152 @@ def list_new_data_files(sftp, s3):
     s3_zip_files = s3.list_files(DATA_ZIPFILE_PAT, S3_PRIVATE_FOLDER)
     new_sftp_zip_files = list(set(sftp_zip_files) - set(s3_zip_files))
 
-    # It's important that everything is processed in order because files 
-    # can contain modify/delete cases included in past files
-    init_files = [f for f in new_sftp_zip_files if 'Initial' in f]
-    incr_files = [f for f in new_sftp_zip_files if 'Incr' in f]
+    return order_data_files(new_sftp_zip_files)
 
-    files = []
-    files += sorted(init_files) if init_files else []
-    files += sorted(incr_files) if incr_files else []
 
-    return files
+def list_unapplied_data_files(sftp, db):
+    """ 
+    Get a list of filenames for all the data files available in the SFTP 
+    that have not been applied to the database yet, according to the 
+    ledger in the oca_ingest_files table. They are returned in the proper 
+    order in which they need to be processed.
+
+    :param sftp: SFTP object
+    :param db: Database object
+    """
+    sftp_zip_files = sftp.list_files(DATA_ZIPFILE_PAT)
+
+    return order_data_files(list(set(sftp_zip_files) - set(list_applied_data_files(db))))
+
+
+def list_unpublished_data_files(sftp, s3, db):
+    """ 
+    Get a list of filenames for the data files that have been applied to 
+    the database but are not in the private S3 folder yet (eg. because a 
+    run failed after merging them). They have to be uploaded with the next 
+    dump, otherwise a database restored from that dump would apply them 
+    again on top of newer data. Only files still on the SFTP are listed.
+
+    :param sftp: SFTP object
+    :param s3: S3 object
+    :param db: Database object
+    """
+    sftp_zip_files = sftp.list_files(DATA_ZIPFILE_PAT)
+    s3_zip_files = s3.list_files(DATA_ZIPFILE_PAT, S3_PRIVATE_FOLDER)
+    applied_files = list_applied_data_files(db)
+
+    return order_data_files(list(set(applied_files) & set(sftp_zip_files) - set(s3_zip_files)))
+
+
+def list_applied_data_files(db):
+    """ 
+    Get the filenames in the ledger of data files applied to the database, 
+    in the order in which they were processed
+
+    :param db: Database object
+    """
+    return order_data_files([f for f, in db.query("SELECT filename FROM oca_ingest_files")])
 
 
-def prep_db(s3, db, local_dir):
+def record_applied_file(db, zip_file):
+    """ 
+    Add a data file to the ledger of files applied to the database
+
+    :param db: Database object
+    :param zip_file: path to the local data zip file
+    """
+    db.sql(
+        "INSERT INTO oca_ingest_files (filename) VALUES (%s) ON CONFLICT (filename) DO NOTHING", 
+        (os.path.basename(zip_file),)
+    )
+
+
+def get_ingest_state(db, key):
+    """ get a value from the oca_ingest_state table, or None if it isn't set """
+    rows = db.query("SELECT value FROM oca_ingest_state WHERE key = %s", (key,))
+    return rows[0][0] if rows else None
+
+
+def set_ingest_state(db, key, value):
+    """ set a value in the oca_ingest_state table """
+    db.sql("""
+        INSERT INTO oca_ingest_state (key, value) VALUES (%s, %s) 
+        ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value
+    """, (key, value))
+
+
+def interrupted_load(db, rebuild, dump_fingerprint):
+    """
+    Whether the database holds a load from scratch (or a rebuild) that was 
+    interrupted before it uploaded a dump. Its ledger and the checkpoints 
+    of its staging tables are kept so the next run can carry on from 
+    there, unless (when not rebuilding) there's now a dump to restore.
+
+    :param db: Database object
+    :param rebuild: whether this run is a rebuild
+    :param dump_fingerprint: S3 ETag of the latest dump, or None if there 
+        isn't one
+    """
+    if get_ingest_state(db, 'from_scratch') is None:
+        return False
+    return rebuild or dump_fingerprint is None
+
+
+def get_parse_checkpoint(db, zip_file):
+    """ 
+    Get the number of cases of a data file already loaded into the staging 
+    tables by an interrupted run, or 0 if it needs to be parsed from the 
+    start. A checkpoint is only used if the staging tables still hold 
+    exactly that many cases (every case is one row of either 
+    oca_index_staging or oca_deletes_staging), since eg. unlogged tables 
+    are emptied when the database crashes.
+
+    :param db: Database object
+    :param zip_file: path to the local data zip file
+    """
+    rows = db.query(
+        "SELECT cases FROM oca_parse_checkpoints WHERE filename = %s", 
+        (os.path.basename(zip_file),)
+    )
+    if not rows:
+        return 0
+
+    tables_exist, = db.query("""
+        SELECT to_regclass('oca_index_staging') IS NOT NULL 
+            AND to_regclass('oca_deletes_staging') IS NOT NULL
+    """)[0]
+    if not tables_exist:
+        return 0
+
+    staged_cases, = db.query("""
+        SELECT (SELECT count(*) FROM oca_index_staging) 
+            + (SELECT count(*) FROM oca_deletes_staging)
+    """)[0]
+    return rows[0][0] if staged_cases == rows[0][0] else 0
+
+
+def save_parse_checkpoint(db, zip_file, cases):
+    """ 
+    Record the number of cases of a data file loaded into the staging 
+    tables so far. This doesn't commit, so that it's saved in the same 
+    transaction as the rows of those cases.
+
+    :param db: Database object
+    :param zip_file: path to the local data zip file
+    :param cases: number of cases loaded
+    """
+    db.execute("""
+        INSERT INTO oca_parse_checkpoints (filename, cases) VALUES (%s, %s) 
+        ON CONFLICT (filename) DO UPDATE SET cases = EXCLUDED.cases, updatedat = now()
+    """, (os.path.basename(zip_file), cases))
+
+
+def clear_parse_checkpoint(db, zip_file):
+    """ remove the checkpoint of a data file, once it's staged from scratch or merged """
+    db.sql("DELETE FROM oca_parse_checkpoints WHERE filename = %s", (os.path.basename(zip_file),))
+
+
+def prep_db(s3, db, local_dir, cache=None):
     """ 
     Create a new directory in the same folder as this file, 
     deleting everything in the folder if it already exists 
@@ -81,25 +262,55 @@ def prep_db(s3, db, local_dir):
     :param s3: S3 object
     :param db: Database object
     :param local_dir: Path for local directory to save database dump file
+    :param cache: FileCache to keep the dump in between runs (or None)
+    :return: True if the tables were created from scratch
     """
-    if s3.list_files('oca.dump', S3_PRIVATE_FOLDER):
+    if s3.list_files(re.escape(DUMP_FILENAME) + '$', S3_PRIVATE_FOLDER):
         print('Rebuilding tables from SQL dump')
-        s3.download_file(f"{S3_PRIVATE_FOLDER}/oca.dump", os.path.join(local_dir, 'oca.dump'))
-        db.restore_from(os.path.join(local_dir, 'oca.dump'))
+        dump_object = f"{S3_PRIVATE_FOLDER}/{DUMP_FILENAME}"
+        if cache is None:
+            dump_path = os.path.join(local_dir, DUMP_FILENAME)
+            s3.download_file(dump_object, dump_path)
+        else:
+            dump_path, hit = cache.fetch(
+                dump_object, s3.object_etag(dump_object), functools.partial(s3.download_file, dump_object)
+            )
+            if hit:
+                print('- Found the SQL dump in the local cache')
+        db.restore_from(dump_path)
+    elif s3.list_files(re.escape(LEGACY_DUMP_FILENAME) + '$', S3_PRIVATE_FOLDER):
+        print('Rebuilding tables from older SQL dump')
+        legacy_dump = os.path.join(local_dir, LEGACY_DUMP_FILENAME)
+        s3.download_file(f"{S3_PRIVATE_FOLDER}/{LEGACY_DUMP_FILENAME}", legacy_dump)
+        db.restore_from(legacy_dump)
+        # The next dump replaces it, so it doesn't need to be uploaded again
+        os.remove(legacy_dump)
     else:
         print('Creating tables from scratch')
         db.execute_sql_file('create_tables.sql')
+        return True
+
+    return False
 
 
 def insert_staging_to_main(db):
     """ 
-    Delete all cases from main tables if they exist in the staging table, 
-    then insert all records from the staging tables to the main tables
+    Delete all cases from main tables if they were flagged for deletion or 
+    exist in the staging table, then insert all records from the staging 
+    tables to the main tables
 
     :param db: Database object
     """
 
-    db.sql(f"DELETE FROM oca_index WHERE indexnumberid IN (SELECT indexnumberid FROM oca_index_staging)")
+    db.sql("""
+        DELETE FROM oca_index WHERE indexnumberid IN (
+            SELECT indexnumberid FROM oca_deletes_staging 
+            UNION 
+            SELECT indexnumberid FROM oca_index_staging
+        )
+    """)
+    db.sql("DROP TABLE oca_deletes_staging")
+
     for table in OCA_TABLES:
         db.sql(f"INSERT INTO {table} SELECT * FROM {table}_staging")
         db.sql(f"DROP TABLE {table}_staging")
@@ -124,10 +335,444 @@ def create_date_files(s3, data_file, local_dir):
     open(img_file, 'wb').write(r.content)
 
 
-def oca_etl(db_args, sftp_args, s3_args):
+def export_compressed_csv(db, s3, table_name, compression):
+    """
+    Export a table as a compressed CSV file, streaming it from the database 
+    through the compressor straight into a multipart upload to the public 
+    S3 folder, so the file never lands on disk.
+
+    :param db: Database object
+    :param s3: S3 object
+    :param table_name: name of the table to export
+    :param compression: 'gzip' or 'zstd'
+    """
+    object_name = f"{S3_PUBLIC_FOLDER}/{table_name}{COMPRESSED_CSV_EXTENSIONS[compression]}"
+
+    with s3.open_upload(object_name) as upload:
+        if compression == 'gzip':
+            with gzip.GzipFile(f"{table_name}.csv", 'wb', fileobj=upload) as f:
+                db.export_csv_to(table_name, f)
+        else:
+            if zstandard is None:
+                raise RuntimeError('The zstandard package is needed for zstd exports')
+            # Closing the writer would also close the upload, so only end the frame
+            f = zstandard.ZstdCompressor().stream_writer(upload)
+            db.export_csv_to(table_name, f)
+            f.flush(zstandard.FLUSH_FRAME)
+
+
+def export_tables(db, export_table, workers):
+    """
+    Export all the tables at once over a small pool of connections. All 
+    the connections share the same snapshot of the database, so the 
+    exported tables are consistent with each other. The biggest tables are 
+    started first so that the small ones don't end up waiting behind them.
+
+    :param db: Database object
+    :param export_table: function that exports one table, called with a 
+        Database object and the table name
+    :param workers: number of tables to export at once
+    """
+    sizes = dict(db.query(
+        "SELECT relname, pg_total_relation_size(oid) FROM pg_class WHERE relname = ANY(%s)", 
+        (OCA_TABLES,)
+    ))
+    tables = sorted(OCA_TABLES, key=lambda t: sizes.get(t, 0), reverse=True)
+
+    snapshot = db.export_snapshot()
+    connections = threading.local()
+    worker_dbs = []
+
+    def run(table):
+        if not hasattr(connections, 'db'):
+            connections.db = Database(db.db_url)
+            worker_dbs.append(connections.db)
+        connections.db.use_snapshot(snapshot)
+        export_table(connections.db, table)
+        connections.db.commit()
+
+    try:
+        with ThreadPoolExecutor(workers) as pool:
+            for future in [pool.submit(run, t) for t in tables]:
+                future.result()
+    finally:
+        for worker_db in worker_dbs:
+            worker_db.conn.close()
+        db.commit()
+
+
+def export_delta(db, zip_file, local_dir, coalesced_files=None):
+    """
+    Export the changes from a single data file as a "delta", from its 
+    staging tables before they are merged into the main tables. There is 
+    a CSV for each table with the new/updated rows, and a CSV of the 
+    indexnumberids of every case the file touched (re-sent or deleted). 
+    To apply a delta, first delete all rows for those cases and then 
+    insert the new rows.
+
+    When several Incr files were staged together, there is one delta for 
+    all of them, named after the last one and listing them all in "files".
+
+    :param db: Database object
+    :param zip_file: path to the local data zip file that was staged
+    :param local_dir: local public directory to write the delta files to
+    :param coalesced_files: paths to all the data files staged together 
+        (or None)
+    :return: dict describing the delta for the manifest
+    """
+    name = re.search(r'LandlordTenant\.(.+)\.zip', zip_file).group(1)
+    folder = f"{S3_DELTAS_FOLDER}/{name}"
+    os.makedirs(os.path.join(local_dir, folder), exist_ok=True)
+
+    delta = {
+        'name': name,
+        'file': os.path.basename(zip_file),
+        'created': datetime.datetime.now().isoformat(),
+        'cases': f"{folder}/indexnumberids.csv",
+        'tables': {t: f"{folder}/{t}.csv" for t in OCA_TABLES},
+    }
+    if coalesced_files:
+        delta['files'] = [os.path.basename(f) for f in coalesced_files]
+
+    db.export_csv(
+        "(SELECT indexnumberid FROM oca_deletes_staging UNION SELECT indexnumberid FROM oca_index_staging)", 
+        os.path.join(local_dir, delta['cases'])
+    )
+    for t in OCA_TABLES:
+        db.export_csv(f"{t}_staging", os.path.join(local_dir, delta['tables'][t]))
+
+    return delta
+
+
+def load_manifest(s3):
+    """
+    Get the manifest of the public data: when the last full snapshot of 
+    the tables was published, and the list of deltas published since then
+
+    :param s3: S3 object
+    """
+    data = s3.read_object(f"{S3_PUBLIC_FOLDER}/{S3_DELTAS_FOLDER}/manifest.json")
+    return json.loads(data) if data else {'snapshot': None, 'deltas': []}
+
+
+def add_deltas(manifest, deltas):
+    """
+    Add new deltas to the end of the manifest's list. A file can be applied 
+    again if a run failed after publishing its delta, so any delta already 
+    listed for one of the same data files is replaced rather than listed 
+    twice.
+
+    :param manifest: dict as returned by load_manifest
+    :param deltas: list of dicts as returned by export_delta
+    """
+    def source_files(delta):
+        return set(delta.get('files', [delta['file']]))
+
+    new_files = set().union(*[source_files(d) for d in deltas])
+    manifest['deltas'] = [d for d in manifest['deltas'] if not source_files(d) & new_files] + deltas
+
+
+def is_snapshot_due(manifest, interval_days):
+    """
+    Whether it's time to regenerate the full snapshot of every table
+
+    :param manifest: dict as returned by load_manifest
+    :param interval_days: minimum number of days between full snapshots
+    """
+    if not manifest['snapshot']:
+        return True
+
+    created = datetime.datetime.strptime(manifest['snapshot']['created'][:10], '%Y-%m-%d').date()
+    return (datetime.date.today() - created).days >= interval_days
+
+
+def stage_file(db, zip_file, parse_args, unlogged=False, report=None):
+    """
+    Rebuild the staging tables, unzip the XML file and parse it into the 
+    staging tables, ready to be inserted into the main tables. The 
+    staging tables are indexed and analyzed only once they're loaded.
+
+    Progress is checkpointed as the cases are loaded, so if an earlier run 
+    was interrupted while parsing the same file, the staging tables are 
+    kept and parsing resumes after the last case that was loaded.
+
+    :param db: Database object
+    :param zip_file: path to a local data zip file
+    :param parse_args: dict of keyword arguments for parse_file
+    :param unlogged: make the staging tables unlogged (for fast loads)
+    :param report: RunReport to record the stages in (or None)
+    :return: dict of the number of rows loaded into each staging table 
+        (by this run, if it was resumed)
+    """
+    if report is None:
+        report = RunReport()
+
+    resume_cases = get_parse_checkpoint(db, zip_file)
+    if resume_cases:
+        print(f'  - Resuming after {resume_cases} cases loaded by an interrupted run...')
+    else:
+        print('  - Creating staging tables...')
+        clear_parse_checkpoint(db, zip_file)
+        db.execute_sql_file('create_tables_staging.sql')
+        if unlogged:
+            db.execute_sql_file('set_staging_unlogged.sql')
+
+    # Progress is shown in bytes of the compressed file read so far
+    print('  - Parsing XML file...')
+    zip_size = os.path.getsize(zip_file)
+    with report.stage('parse') as stage, open(zip_file, 'rb') as raw_file:
+        with zipfile.ZipFile(raw_file, 'r').open(DATA_FILENAME) as xml_file:
+            rows = parse_file(
+                xml_file, db, progress=(zip_size, raw_file.tell), 
+                checkpoint=functools.partial(save_parse_checkpoint, db, zip_file), 
+                skip_cases=resume_cases, **parse_args
+            )
+        stage.update(bytes=zip_size, rows=sum(rows.values()), tables=rows)
+
+    print('\n   - Indexing staging tables...')
+    with report.stage('index_staging'):
+        db.execute_sql_file('create_staging_indexes.sql')
+
+    return rows
+
+
+def group_data_files(zip_files, coalesce_incr=False):
+    """
+    Group data files (in the order they need to be processed) into the 
+    batches that are staged and merged together: every file on its own, 
+    or when coalescing, all the Incr files (which always come last) at once
+
+    :param zip_files: paths to local data zip files (each one is grouped 
+        as soon as it is yielded)
+    :param coalesce_incr: stage all the Incr files together
+    """
+    incr_files = []
+    for zip_file in zip_files:
+        if coalesce_incr and 'Incr' in os.path.basename(zip_file):
+            incr_files.append(zip_file)
+        else:
+            yield [zip_file]
+
+    if incr_files:
+        yield incr_files
+
+
+def latest_case_versions(zip_files):
+    """
+    Scan the raw xml of some data files, in the order they need to be 
+    processed, for the last version of every case (either re-sent or 
+    flagged for deletion). Cases are numbered across all the files, in 
+    order, and only the number of the last one sent is kept for each id.
+
+    :param zip_files: paths to local data zip files
+    :return: dict of IndexNumberId to the number of its last version
+    """
+    latest = {}
+    ordinals = itertools.count()
+    for zip_file in zip_files:
+        with zipfile.ZipFile(zip_file, 'r').open(DATA_FILENAME) as xml_file:
+            for case in CaseSplitter(xml_file):
+                latest[case_index_number_id(case)] = next(ordinals)
+
+    return latest
+
+
+def stage_files_coalesced(db, zip_files, parse_args, report=None):
+    """
+    Stage several Incr files at once, with only the last version of every 
+    case sent in any of them, so that they can be merged into the main 
+    tables together. The result is the same as merging them one after the 
+    other, but each case is only parsed, staged and merged once however 
+    many of the files re-send it.
+
+    The files are scanned for the cases to keep first, without parsing 
+    them, then the cases are parsed from each file in turn. There are no 
+    checkpoints, so an interrupted run starts again from the first file.
+
+    :param db: Database object
+    :param zip_files: paths to local Incr data zip files, in order
+    :param parse_args: dict of keyword arguments for parse_file
+    :param report: RunReport to record the stages in (or None)
+    :return: dict of the number of rows loaded into each staging table
+    """
+    if report is None:
+        report = RunReport()
+
+    print('  - Finding the last version of each case...')
+    with report.stage('scan') as stage:
+        latest = latest_case_versions(zip_files)
+        stage.update(bytes=sum(os.path.getsize(f) for f in zip_files), rows=len(latest))
+    print(f'   - {len(latest)} distinct cases')
+
+    print('  - Creating staging tables...')
+    db.execute_sql_file('create_tables_staging.sql')
+
+    # The cases are numbered the same way as in latest_case_versions
+    ordinals = itertools.count()
+    def is_latest(case_id):
+        return latest.get(case_id) == next(ordinals)
+
+    rows = collections.Counter()
+    for zip_file in zip_files:
+        print('  - Parsing', os.path.basename(zip_file))
+        zip_size = os.path.getsize(zip_file)
+        with report.stage('parse') as stage, open(zip_file, 'rb') as raw_file:
+            with zipfile.ZipFile(raw_file, 'r').open(DATA_FILENAME) as xml_file:
+                cases = CaseSplitter(xml_file).filtered(is_latest)
+                file_rows = parse_file(cases, db, progress=(zip_size, raw_file.tell), **parse_args)
+            stage.update(bytes=zip_size, rows=sum(file_rows.values()), tables=file_rows)
+        rows.update(file_rows)
+        print()
+
+    print('   - Indexing staging tables...')
+    with report.stage('index_staging'):
+        db.execute_sql_file('create_staging_indexes.sql')
+
+    return dict(rows)
+
+
+def staging_schema(zip_file):
+    """
+    Name of the schema that holds the staging tables for an Initial file 
+    when they are processed concurrently (eg. "staging_filedin2019")
+
+    :param zip_file: path to a local Initial data zip file
+    """
+    return 'staging_' + re.search(r'FiledIn\d{4}', zip_file).group(0).lower()
+
+
+def stage_file_in_schema(db_url, zip_file, parse_args, unlogged=False):
+    """
+    Stage a file on its own connection in a separate staging schema, so 
+    that many files can be staged at once in different processes.
+
+    :param db_url: database connection string
+    :param zip_file: path to a local data zip file
+    :param parse_args: dict of keyword arguments for parse_file
+    :param unlogged: make the staging tables unlogged (for fast loads)
+    :return: name of the schema with the staging tables
+    """
+    db = Database(db_url)
+    schema = staging_schema(zip_file)
+    db.use_schema(schema)
+    stage_file(db, zip_file, parse_args, unlogged)
+    db.conn.close()
+    return schema
+
+
+def process_initial_files_concurrently(db, zip_files, parse_args, workers, fast_load=False):
+    """
+    The Initial files cover disjoint filing years, so when rebuilding from 
+    scratch they can all be parsed at the same time into their own staging 
+    schemas, then merged into the main tables one after the other. The 
+    secondary indexes of the main tables are dropped while they're merged 
+    and built again once at the end (unless this is part of a fast load, 
+    which takes care of them itself).
+
+    :param db: Database object
+    :param zip_files: paths to local Initial data zip files (each file 
+        starts being processed as soon as it is yielded)
+    :param parse_args: dict of keyword arguments for parse_file
+    :param workers: number of files to stage at once
+    :param fast_load: stage into unlogged tables and leave the indexes to 
+        finish_fast_load
+    """
+
+    # Files are already parsed in parallel, and the pool's processes can't 
+    # start pools of their own
+    parse_args = dict(parse_args, workers=1)
+
+    with process_pool(workers) as pool:
+        futures = []
+        for zip_file in zip_files:
+            print('-', os.path.basename(zip_file))
+            futures.append((zip_file, pool.submit(stage_file_in_schema, db.db_url, zip_file, parse_args, fast_load)))
+        schemas = [(zip_file, future.result()) for zip_file, future in futures]
+
+    # Since the files don't overlap, merging them never deletes anything 
+    # from the main tables, so the indexes aren't needed until the end
+    if not fast_load:
+        db.execute_sql_file('drop_indexes.sql')
+
+    for zip_file, schema in schemas:
+        print('  - Inserting from staging to main for', schema)
+        db.use_schema(schema)
+        insert_staging_to_main(db)
+        db.sql(f"SET search_path TO public; DROP SCHEMA {schema} CASCADE")
+        record_applied_file(db, zip_file)
+        clear_parse_checkpoint(db, zip_file)
+
+    if not fast_load:
+        print('  - Rebuilding indexes...')
+        db.execute_sql_file('create_indexes.sql')
+        db.sql("ANALYZE")
+
+
+def start_fast_load(db):
+    """
+    When the tables are created from scratch, the Initial files are loaded 
+    into the main tables without foreign keys or secondary indexes, which 
+    would otherwise be checked and updated for every row. They are added 
+    back by finish_fast_load once all the Initial files are in.
+
+    :param db: Database object
+    """
+    print('Dropping constraints and indexes for fast load')
+    db.execute_sql_file('drop_constraints.sql')
+    db.execute_sql_file('drop_indexes.sql')
+    set_ingest_state(db, 'fast_load', datetime.datetime.now().isoformat())
+
+
+def finish_fast_load(db):
+    """
+    Add back the foreign keys and indexes dropped by start_fast_load and 
+    analyze the tables. Adding the foreign keys checks every row, so this 
+    raises an error if the fast load broke any of them.
+
+    :param db: Database object
+    """
+    print('Validating constraints and rebuilding indexes after fast load')
+    db.execute_sql_file('create_constraints.sql')
+    db.execute_sql_file('create_indexes.sql')
+    db.sql("ANALYZE")
+    set_ingest_state(db, 'fast_load', None)
+
+
+def oca_etl(db_args, sftp_args, s3_args, parse_args={}, rebuild=False, rebuild_workers=4, 
+            pipeline_depth=1, export_formats=['csv'], export_workers=4, snapshot_interval_days=0, 
+            fast_load=False, coalesce_incr=False, cache_dir=None, cache_max_bytes=20 * 1024 ** 3, 
+            report=None):
     """ 
     Extract files from SFTP, parse cases, upload to S3 bucket
+
+    :param parse_args: dict of keyword arguments for parse_file 
+        (eg. buffer thresholds)
+    :param rebuild: ignore the existing SQL dump and rebuild the database 
+        from scratch using every data file on the SFTP
+    :param rebuild_workers: number of Initial files to parse at once when 
+        rebuilding
+    :param pipeline_depth: number of files that can be downloaded ahead of 
+        parsing, and exported ahead of uploading
+    :param export_formats: list of formats to publish the tables in, 'csv' 
+        for plain CSV files, 'gzip'/'zstd' for compressed CSV files and/or 
+        'parquet' for Parquet files partitioned by filing year
+    :param snapshot_interval_days: days between full exports of the tables 
+        (only deltas are published in between)
+    :param fast_load: when the tables are created from scratch, load the 
+        Initial files without foreign keys or indexes and into unlogged 
+        staging tables, then add them back and validate them
+    :param coalesce_incr: stage and merge all the new Incr files at once, 
+        with only the last version of every case
+    :param cache_dir: directory to keep the SQL dump and raw data files 
+        in between runs, so they're only downloaded when they change (or 
+        None to always download them)
+    :param cache_max_bytes: size the cache is kept under, by removing the 
+        least recently used files
+    :param report: RunReport to record the time, bytes and rows of each 
+        stage in (or None)
     """
+    if report is None:
+        report = RunReport()
 
     db = Database(**db_args)
 
@@ -135,6 +780,8 @@ def oca_etl(db_args, sftp_args, s3_args):
 
     s3 = S3(**s3_args)
 
+    cache = FileCache(cache_dir, cache_max_bytes) if cache_dir else None
+
     # For debugging only
     # priv_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data-private'))
     # pub_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), 'data-public'))
@@ -143,74 +790,284 @@ def oca_etl(db_args, sftp_args, s3_args):
     priv_dir = make_dir('data-private') # "private/"
     pub_dir = make_dir('data-public') # "public/"
     
-    # Get list of new files to download from SFTP
-    new_sftp_zip_files = list_new_data_files(sftp, s3)
+    # The database keeps a ledger of the data files applied to it and the 
+    # fingerprint of the dump it matches. If the database persisted since 
+    # the last run and still matches the latest dump on S3, there's no need 
+    # to restore it and the ledger says which files are new.
+    db.execute_sql_file('create_ingest_state.sql')
+    dump_fingerprint = s3.object_etag(f"{S3_PRIVATE_FOLDER}/{DUMP_FILENAME}")
+    db_is_current = (
+        not rebuild 
+        and dump_fingerprint is not None 
+        and get_ingest_state(db, 'dump_fingerprint') == dump_fingerprint
+    )
+    resume_load = not db_is_current and interrupted_load(db, rebuild, dump_fingerprint)
+
+    # Get list of new files to download from SFTP (or all of them for a rebuild), 
+    # and of the files already applied that a failed run never published
+    unpublished_zip_files = []
+    with report.stage('list') as stage:
+        if db_is_current or resume_load:
+            new_sftp_zip_files = list_unapplied_data_files(sftp, db)
+            unpublished_zip_files = list_unpublished_data_files(sftp, s3, db)
+        elif rebuild:
+            new_sftp_zip_files = order_data_files(sftp.list_files(DATA_ZIPFILE_PAT))
+        else:
+            new_sftp_zip_files = list_new_data_files(sftp, s3)
+        stage['rows'] = len(new_sftp_zip_files)
 
-    # If there are no new files we can stop everything here. 
-    if not new_sftp_zip_files:
+    # If there are no new files we can stop everything here. An interrupted 
+    # load from scratch still has to be finished and published, even if 
+    # all its files were merged before it stopped.
+    if not new_sftp_zip_files and not unpublished_zip_files and not resume_load:
         print('No new files to download from SFTP. Stopping process.')
         return True
 
+    # Full exports of every table are only published on a schedule, the 
+    # rest of the time only the deltas are. A run that failed before 
+    # publishing may not have published its deltas either.
+    manifest = load_manifest(s3)
+    full_export = (
+        rebuild or resume_load or bool(unpublished_zip_files) 
+        or is_snapshot_due(manifest, snapshot_interval_days)
+    )
+
     # Before we can parse any file we need to set up the tables in the database. 
     # If there is already a SQL dump in the S3 bucket we can rebuild from there, 
     # otherwise we create the tables fresh.
-    prep_db(s3, db, priv_dir)
+    from_scratch = rebuild or resume_load
+    if db_is_current:
+        print('Database already matches the latest SQL dump, skipping restore')
+    elif resume_load:
+        print('Resuming the interrupted load from scratch')
+        # An interrupted fast load builds the indexes once it's done
+        if get_ingest_state(db, 'fast_load') is None:
+            db.execute_sql_file('create_indexes.sql')
+    else:
+        with report.stage('restore'):
+            db.sql("TRUNCATE oca_ingest_files, oca_ingest_state, oca_parse_checkpoints")
+            if rebuild:
+                print('Creating tables from scratch for rebuild')
+                db.execute_sql_file('create_tables.sql')
+            else:
+                from_scratch = prep_db(s3, db, priv_dir, cache)
+                db.execute_sql_file('create_ingest_state.sql')
+
+                # Older dumps don't have a ledger, but every file in the private 
+                # S3 folder has been applied to them
+                if not db.query("SELECT 1 FROM oca_ingest_files LIMIT 1"):
+                    for f in s3.list_files(DATA_ZIPFILE_PAT, S3_PRIVATE_FOLDER):
+                        record_applied_file(db, f)
+
+                # A dump can include files whose upload failed after its own, 
+                # which only need to be published, not applied again
+                applied_files = set(list_applied_data_files(db))
+                unpublished_zip_files = [f for f in new_sftp_zip_files if f in applied_files]
+                new_sftp_zip_files = [f for f in new_sftp_zip_files if f not in applied_files]
+
+            # Until its dump is uploaded, an interrupted run can carry on 
+            # with this load instead of starting it over
+            if from_scratch:
+                set_ingest_state(db, 'from_scratch', datetime.datetime.now().isoformat())
 
-    # If there are new files, download them
-    print('Downloading new files from SFTP:')
-    for f in new_sftp_zip_files:
-        print('-', f)
-        sftp.download_files(f, priv_dir)
+            db.execute_sql_file('create_indexes.sql')
 
-    # For each of the new data files, parse it into the database
-    local_zip_files = [os.path.join(priv_dir, f) for f in new_sftp_zip_files]
+    # If there are new files, download them. Files are downloaded in the 
+    # background while the ones before them are being parsed, several at 
+    # once but never more than pipeline_depth files ahead, and files are 
+    # always handed over in the order they need to be processed.
+    def download(f):
+        if cache is None:
+            with report.stage('download') as stage:
+                local_file = sftp.download_file(f, priv_dir)
+                stage['bytes'] = os.path.getsize(local_file)
+            print('- Downloaded', f)
+            return local_file
+
+        # Cached files are only linked into the private folder, which is 
+        # never written to in place
+        with report.stage('download') as stage:
+            cached_file, hit = cache.fetch(
+                f, sftp.file_version(f), lambda path: sftp.download_file(f, os.path.dirname(path))
+            )
+            local_file = os.path.join(priv_dir, f)
+            link_or_copy(cached_file, local_file)
+            stage['bytes'] = 0 if hit else os.path.getsize(local_file)
+        print('- Found in cache' if hit else '- Downloaded', f)
+        return local_file
+
+    download_pool = ThreadPoolExecutor(sftp.max_files)
+    local_zip_files = bounded_map(download_pool, download, new_sftp_zip_files, pipeline_depth + 1)
 
     # For each zipfile, rebuild the staging tables, unzip the XML file and 
     # parse it into the staging tables, then insert all the newly parsed records 
     # into the main tables.
     print('Processing files:')
-    for zip_file in local_zip_files:
-        print('-', os.path.basename(zip_file))
 
-        print('  - Creating staging tables...')
-        db.execute_sql_file('create_tables_staging.sql')
+    # When the tables are new, the Initial files (which always come first) 
+    # can be bulk loaded without constraints or indexes
+    init_count = len([f for f in new_sftp_zip_files if 'Initial' in f])
+    fast_load = fast_load and from_scratch and init_count > 0
 
-        print('  - Parsing XML file...')
-        with zipfile.ZipFile(zip_file, 'r').open(DATA_FILENAME) as xml_file:
-            parse_file(xml_file, db)
+    # An interrupted fast load still has to add back what it dropped
+    fast_load = fast_load or get_ingest_state(db, 'fast_load') is not None
+    if fast_load:
+        start_fast_load(db)
+
+    # When rebuilding, all the Initial files can be processed at once and 
+    # only the Incr files need to go one after the other
+    if rebuild and init_count:
+        init_zip_files = itertools.islice(local_zip_files, init_count)
+        with report.stage('initial') as stage:
+            process_initial_files_concurrently(db, init_zip_files, parse_args, rebuild_workers, fast_load)
+            stage['bytes'] = sum(
+                os.path.getsize(os.path.join(priv_dir, f)) for f in new_sftp_zip_files if 'Initial' in f
+            )
+
+    # When several Incr files are pending (eg. after an outage) they can be 
+    # coalesced, so that a case re-sent in many of them is only staged once
+    deltas = []
+    for zip_files in group_data_files(local_zip_files, coalesce_incr):
+        zip_file = zip_files[-1]
+        print('-', ', '.join(os.path.basename(f) for f in zip_files))
+
+        # The Incr files can delete cases, so they need the foreign keys
+        if fast_load and 'Initial' not in os.path.basename(zip_file):
+            with report.stage('finish_fast_load'):
+                finish_fast_load(db)
+            fast_load = False
 
-        print('\n   - Updating appearance outcomes...')
-        db.execute_sql_file('update_appearance_outcomes.sql')
+        if len(zip_files) > 1:
+            rows = stage_files_coalesced(db, zip_files, parse_args, report)
+        else:
+            rows = stage_file(db, zip_file, parse_args, fast_load, report)
 
+        # A full export starts the list of deltas over, so it wouldn't list them
+        if not full_export:
+            print('  - Exporting delta...')
+            with report.stage('delta') as stage:
+                deltas.append(export_delta(db, zip_file, pub_dir, zip_files if len(zip_files) > 1 else None))
+                stage.update(rows=sum(rows.values()), bytes=sum(
+                    os.path.getsize(os.path.join(pub_dir, f)) 
+                    for f in [deltas[-1]['cases']] + list(deltas[-1]['tables'].values())
+                ))
+
+        # Once anything is merged the database no longer matches the last 
+        # dump, so if this run fails the next one restores the dump and 
+        # applies the files again instead of finding nothing new
         print('  - Inserting from staging to main...')
-        insert_staging_to_main(db)
+        with report.stage('merge') as stage:
+            set_ingest_state(db, 'dump_fingerprint', None)
+            insert_staging_to_main(db)
+            for f in zip_files:
+                record_applied_file(db, f)
+                clear_parse_checkpoint(db, f)
+            stage.update(rows=sum(rows.values()), tables=rows)
+
+    # The raw files of unpublished files are needed for the private upload
+    for local_file in download_pool.map(download, unpublished_zip_files):
+        pass
+    download_pool.shutdown()
+
+    if fast_load:
+        with report.stage('finish_fast_load'):
+            finish_fast_load(db)
 
     # Create/upload a dump of the database to start with for next update
     print('Creating database dump and uploading to s3')
-    db.dump_to(os.path.join(priv_dir, 'oca.dump'))
-
-    # Export tables as CSVs
-    for t in OCA_TABLES:
-        csv_filepath = os.path.join(pub_dir, f"{t}.csv")
-        db.export_csv(t, csv_filepath)
+    # The mark of a load from scratch is left out of the dump, otherwise a 
+    # database restored from it would look like an interrupted load. It's 
+    # kept here until the uploads are done, in case they fail.
+    with report.stage('dump') as stage:
+        from_scratch_started = get_ingest_state(db, 'from_scratch')
+        set_ingest_state(db, 'from_scratch', None)
+        try:
+            db.dump_to(os.path.join(priv_dir, DUMP_FILENAME))
+        finally:
+            if from_scratch_started is not None:
+                set_ingest_state(db, 'from_scratch', from_scratch_started)
+        stage['bytes'] = os.path.getsize(os.path.join(priv_dir, DUMP_FILENAME))
 
     s3 = S3(**s3_args)
 
+    # Export tables as CSVs, uploading each one to the public folder in 
+    # the S3 bucket while the next tables are being exported
+    def upload_public(f):
+        with report.stage('upload') as stage:
+            s3.upload_file(f"{S3_PUBLIC_FOLDER}/{f}", os.path.join(pub_dir, f))
+            stage['bytes'] = os.path.getsize(os.path.join(pub_dir, f))
+        print('- Uploaded', f)
+
+    # The last file applied, which may be from an earlier run if this one 
+    # only publishes files
+    latest_zip_file = list_applied_data_files(db)[-1]
+
+    print('Exporting and uploading public files to S3:')
+    uploads = BackgroundQueue(upload_public, pipeline_depth)
+
+    for delta in deltas:
+        for f in [delta['cases']] + list(delta['tables'].values()):
+            uploads.put(f)
+
+    def export_table(export_db, t):
+        if 'csv' in export_formats:
+            csv_filepath = os.path.join(pub_dir, f"{t}.csv")
+            export_db.export_csv(t, csv_filepath)
+            uploads.put(os.path.basename(csv_filepath))
+
+        for compression in COMPRESSED_CSV_EXTENSIONS:
+            if compression in export_formats:
+                export_compressed_csv(export_db, s3, t, compression)
+
+        if 'parquet' in export_formats:
+            for f in export_parquet(export_db, t, os.path.join(pub_dir, 'parquet')):
+                uploads.put(os.path.relpath(f, pub_dir))
+
+    # A new snapshot already includes all the changes so far, so the list 
+    # of deltas since the snapshot starts over
+    if full_export:
+        with report.stage('export'):
+            export_tables(db, export_table, export_workers)
+        manifest = {
+            'snapshot': {
+                'created': datetime.datetime.now().isoformat(), 
+                'file': latest_zip_file
+            },
+            'deltas': []
+        }
+    else:
+        add_deltas(manifest, deltas)
+
+    manifest_file = os.path.join(S3_DELTAS_FOLDER, 'manifest.json')
+    os.makedirs(os.path.join(pub_dir, S3_DELTAS_FOLDER), exist_ok=True)
+    with open(os.path.join(pub_dir, manifest_file), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    uploads.put(manifest_file)
+
     # Update "last updated date" files on S3 for the latest file processed
-    create_date_files(s3, new_sftp_zip_files[-1], pub_dir)
+    create_date_files(s3, latest_zip_file, pub_dir)
+    uploads.put('last-updated-date.txt')
+    uploads.put('last-updated-shield.png')
 
-    # TODO: upload in parallel
-    # http://ls.pwd.io/2013/06/parallel-s3-uploads-using-boto-and-threads-in-python/
-    
-    # Upload csv files to public folder in S3 bucket
-    print('Uploading public files to S3:')
-    for f in os.listdir(pub_dir):
-        print('-', f)
-        s3.upload_file(f"{S3_PUBLIC_FOLDER}/{f}", os.path.join(pub_dir, f))
+    uploads.join()
 
-    # Upload raw data files and database dump to private folder in S3 bucket
+    # Upload raw data files and database dump to private folder in S3 bucket. 
+    # The dump goes first: a raw file on S3 is never applied again, so it 
+    # can't be there before a dump that includes it
     print('Uploading private files to S3:')
-    for f in os.listdir(priv_dir):
-        print('-', f)
-        s3.upload_file(f"{S3_PRIVATE_FOLDER}/{f}", os.path.join(priv_dir, f))
+    private_files = [
+        (f"{S3_PRIVATE_FOLDER}/{f}", os.path.join(priv_dir, f)) for f in os.listdir(priv_dir)
+    ]
+    dump_files = [(name, path) for name, path in private_files if os.path.basename(path) == DUMP_FILENAME]
+    raw_files = [(name, path) for name, path in private_files if os.path.basename(path) != DUMP_FILENAME]
+    with report.stage('upload_private') as stage:
+        uploaded = s3.upload_files(dump_files, skip_existing=True) + s3.upload_files(raw_files, skip_existing=True)
+        stage['bytes'] = sum(os.path.getsize(path) for name, path in private_files if name in uploaded)
 
+    # The database now matches the dump that was just uploaded, and the next 
+    # run on this host can start from the cached copy
+    dump_fingerprint = s3.object_etag(f"{S3_PRIVATE_FOLDER}/{DUMP_FILENAME}")
+    if cache is not None:
+        cache.put(f"{S3_PRIVATE_FOLDER}/{DUMP_FILENAME}", dump_fingerprint, os.path.join(priv_dir, DUMP_FILENAME))
+    set_ingest_state(db, 'dump_fingerprint', dump_fingerprint)
+    set_ingest_state(db, 'from_scratch', None)
@@ -0,0 +1,29 @@
+import os
+import resource
+
+
+def current_rss():
+    """ resident memory of this process right now, in bytes """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        # Outside of linux the best we have is the peak
+        return peak_rss()
+
+
+def peak_rss():
+    """ peak resident memory of this process in bytes """
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def check_memory(max_rss):
+    """ 
+    Raise a MemoryError if this process uses more than max_rss bytes, so 
+    that it stops with a clear error before the OOM killer ends it
+
+    :param max_rss: memory ceiling in bytes (None for no limit)
+    """
+    if max_rss and current_rss() > max_rss:
+        raise MemoryError(f"Memory use of {current_rss() / 1e6:.0f} MB is over the limit of {max_rss / 1e6:.0f} MB")
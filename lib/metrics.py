@@ -0,0 +1,141 @@
+import collections
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+
+class RunReport:
+    """
+    Collects the wall time, bytes and rows of every stage of a run (eg.
+    "download", "parse", "merge"), so that the throughput of nightly runs
+    can be compared and a slow stage stands out. Stages that happen once
+    per file are added up over all the files. Some stages run in the
+    background at the same time as others (downloads, uploads), so their
+    times can add up to more than the length of the run.
+
+    It's safe to record stages from several threads at once.
+    """
+
+    def __init__(self):
+        self.started = datetime.datetime.now()
+        self.start_time = time.perf_counter()
+        self.seconds = None
+        self.status = 'running'
+        self.stages = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+
+    def add(self, stage, seconds=0, bytes=0, rows=0, tables=None):
+        """
+        Adds to the totals of a stage
+
+        :param stage: name of the stage
+        :param seconds: time taken
+        :param bytes: size of the data processed (eg. downloaded file)
+        :param rows: number of rows processed
+        :param tables: dict of rows processed for each table
+        """
+        with self.lock:
+            totals = self.stages.setdefault(stage, {
+                'count': 0, 'seconds': 0, 'bytes': 0, 'rows': 0, 'tables': collections.Counter(),
+            })
+            totals['count'] += 1
+            totals['seconds'] += seconds
+            totals['bytes'] += bytes
+            totals['rows'] += rows
+            totals['tables'].update(tables or {})
+
+
+    @contextlib.contextmanager
+    def stage(self, stage):
+        """
+        Times a block of code as a stage. This yields a dict that the block
+        can fill in with the 'bytes', 'rows' and 'tables' it processed. The
+        time is recorded even if the block raises an error.
+
+        :param stage: name of the stage
+        """
+        counts = {}
+        start = time.perf_counter()
+        try:
+            yield counts
+        finally:
+            self.add(stage, time.perf_counter() - start, **counts)
+
+
+    def finish(self, status):
+        """ records how long the whole run took and how it ended ('success' or 'failure') """
+        self.seconds = time.perf_counter() - self.start_time
+        self.status = status
+
+
+    def to_dict(self):
+        stages = collections.OrderedDict()
+        with self.lock:
+            for stage, totals in self.stages.items():
+                seconds = totals['seconds']
+                stages[stage] = {
+                    'count': totals['count'],
+                    'seconds': round(seconds, 3),
+                    'bytes': totals['bytes'],
+                    'rows': totals['rows'],
+                    'bytes_per_second': round(totals['bytes'] / seconds) if seconds else None,
+                    'rows_per_second': round(totals['rows'] / seconds) if seconds else None,
+                    'tables': dict(totals['tables']),
+                }
+
+        return {
+            'started': self.started.isoformat(),
+            'seconds': round(self.seconds, 3) if self.seconds is not None else None,
+            'status': self.status,
+            'stages': stages,
+        }
+
+
+    def write_json(self, file_path):
+        with open(file_path, 'w') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+    def write_prometheus(self, file_path):
+        """
+        Writes the report in the Prometheus text format, for the textfile
+        collector of the node exporter. The file is written to a temporary
+        name first and then renamed, so it's never read half written.
+        """
+        report = self.to_dict()
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                label_text = ','.join(f'{k}="{v}"' for k, v in labels.items())
+                lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+
+        metric('oca_etl_last_run_timestamp_seconds', 'Time the last run started.', [
+            ({}, self.started.timestamp()),
+        ])
+        metric('oca_etl_last_run_duration_seconds', 'Length of the last run.', [
+            ({}, report['seconds'] or 0),
+        ])
+        metric('oca_etl_last_run_success', 'Whether the last run finished without errors.', [
+            ({}, int(report['status'] == 'success')),
+        ])
+        for field in ('seconds', 'bytes', 'rows'):
+            metric(f"oca_etl_stage_{field}", f"Total {field} of each stage in the last run.", [
+                ({'stage': stage}, totals[field]) for stage, totals in report['stages'].items()
+            ])
+        metric('oca_etl_stage_table_rows', 'Rows of each table processed by each stage in the last run.', [
+            ({'stage': stage, 'table': table}, rows)
+            for stage, totals in report['stages'].items()
+            for table, rows in totals['tables'].items()
+        ])
+
+        tmp_path = file_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(tmp_path, file_path)
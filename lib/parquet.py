@@ -0,0 +1,117 @@
+import itertools
+import os
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+# Name of the partition column added to every table, from oca_index.fileddate
+PARTITION_COLUMN = 'filedyear'
+
+
+def arrow_type(udt_name):
+    """ 
+    Map a postgres column type (as created by create_tables.sql) to the 
+    matching arrow type 
+
+    :param udt_name: type name from information_schema.columns.udt_name
+    """
+    return {
+        'text': pa.string(),
+        'date': pa.date32(),
+        'timestamp': pa.timestamp('us'),
+        # numeric columns are money amounts, so a fixed scale is plenty
+        'numeric': pa.decimal128(38, 9),
+        'int4': pa.int32(),
+        'int8': pa.int64(),
+        'bool': pa.bool_(),
+        '_text': pa.list_(pa.string()),
+    }[udt_name]
+
+
+def table_schema(db, table_name):
+    """ 
+    Build the arrow schema for a table from the column types in the database
+
+    :param db: Database object
+    :param table_name: name of the table
+    """
+    # Not db.query, which commits and so would end the transaction of a 
+    # snapshot shared with other connections (see etl.export_tables)
+    with db.conn.cursor() as curs:
+        curs.execute("""
+            SELECT column_name, udt_name 
+            FROM information_schema.columns 
+            WHERE table_schema = 'public' AND table_name = %s 
+            ORDER BY ordinal_position
+        """, (table_name,))
+        columns = curs.fetchall()
+
+    return pa.schema([pa.field(name, arrow_type(udt)) for name, udt in columns])
+
+
+def partition_path(year):
+    """ hive-style directory name for a filing year partition """
+    return f"{PARTITION_COLUMN}={year if year is not None else '__HIVE_DEFAULT_PARTITION__'}"
+
+
+def export_parquet(db, table_name, dir_path, batch_size=100000):
+    """
+    Export a table as Parquet files partitioned by filing year (eg. 
+    "oca_events/filedyear=2019/part-0.parquet"). Rows are streamed from 
+    the database in record batches so memory stays flat, and sorted by 
+    court within each year so row group statistics can be used to skip 
+    data when filtering by court. Every table is partitioned by the filing 
+    year of its case in oca_index.
+
+    :param db: Database object
+    :param table_name: name of the table to export
+    :param dir_path: local directory to write the table's folder to
+    :param batch_size: number of rows in each record batch
+    :return: list of paths of the files written
+    """
+    if pa is None:
+        raise RuntimeError('The pyarrow package is needed for Parquet exports')
+
+    schema = table_schema(db, table_name)
+
+    # oca_index has the filing date itself, other tables get it from their case
+    if table_name == 'oca_index':
+        source, case = 'oca_index AS t', 't'
+    else:
+        source, case = f"{table_name} AS t JOIN oca_index AS i ON i.indexnumberid = t.indexnumberid", 'i'
+
+    rows = db.fetch_batches(f"""
+        SELECT t.*, extract(year FROM {case}.fileddate)::int AS {PARTITION_COLUMN}
+        FROM {source}
+        ORDER BY {PARTITION_COLUMN}, {case}.court
+    """, batch_size)
+
+    files = []
+    writer = None
+    year = None
+
+    try:
+        for batch in rows:
+            # Rows are sorted by year, so each partition is written in one go
+            for batch_year, year_rows in itertools.groupby(batch, key=lambda r: r[-1]):
+                if writer is None or batch_year != year:
+                    if writer is not None:
+                        writer.close()
+                    year = batch_year
+                    file_path = os.path.join(dir_path, table_name, partition_path(year), 'part-0.parquet')
+                    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+                    writer = pq.ParquetWriter(file_path, schema)
+                    files.append(file_path)
+
+                columns = list(zip(*year_rows))[:-1]
+                arrays = [pa.array(c, type=f.type) for c, f in zip(columns, schema)]
+                writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+    return files
@@ -1,26 +1,17 @@
+import collections
+import csv
 import frogress
+import functools
+import io
+import itertools
+import os
+import re
 from lxml import etree
 
-def drop_case_rows(case, db):
-    """ 
-    Remove a single case from all the main tables in the database 
-    (all other main tables reference the id in the oca_index table 
-    and the deletion cascades to those tables)
-
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
-    """
-    case_id = case.find(oca_tag('IndexNumberId')).text
-    db.sql(f"DELETE FROM oca_index WHERE indexnumberid = '{case_id}';")
-
-
-def is_case_to_delete(case):
-    """ Determine if a case should from the database
-
-    :param case: an lxml.etree element for a case index
-    :return: boolean
-    """
-    return case.find(oca_tag('Delete')) is not None
+from .database import StagingBuffer, copy_text_rows
+from .memory import check_memory, current_rss, peak_rss
+from .pipeline import bounded_map, process_pool
+from .splitter import CaseSplitter
 
 
 # when refering to XML tags we need to have the "namespace" included as well
@@ -33,440 +24,578 @@ def oca_tag(tag):
     return '{http://www.example.org/LandlordTenantExtractSchema}' + tag
 
 
-# if there is no element to find calling text method raises error
-def oca_extract(elem, tag):
-    """ find the first occurance of an xml tag and extract the
-
-    :param elem: an lxml.etree element
-    :param tag: an xml tag to find
-    :return: string for node text
-    """
-    x = elem.find(oca_tag(tag))
-    return None if x is None else x.text
-
+# Name of the xml file inside every data zip file
+DATA_FILENAME = 'LandlordTenantExtract.xml'
 
-# some attributes can have multiple values that we want to keep on in the same table/row,
-# so we format these for insertion into postgres array. These are either 1 or 2 levels deep.
+INDEX_TAG = oca_tag('Index')
+INDEX_NUMBER_ID_TAG = oca_tag('IndexNumberId')
+DELETE_TAG = oca_tag('Delete')
 
-def oca_extract_array1(elem, parent_tag, child_tag):
-    """ find the first node for given parent tag then extract the text 
-    for all children matching the child tag as a postgres array string
-
-    :param elem: an lxml.etree element
-    :param parent_tag: an xml tag for the parent node
-    :param child_tag: an xml tag for the children nodes
-    :return: postgres array string (eg. {foo, bar}) or None
-    """
-    parent_elem = elem.find(oca_tag(parent_tag))
-
-    if parent_elem is not None:
-       return "{" + ','.join([ i.text for i in parent_elem.findall(oca_tag(child_tag)) ]) + "}"
-    else:
-        return None
+# There are no unique identifiers to link appearances with their outcomes 
+# in the original data, so the parser gives each appearance an id from 
+# the sequence of the oca_appearances table
+APPEARANCE_ID_SEQUENCE = 'oca_appearances_appearanceid_seq'
 
-
-def oca_extract_array2(elem, grandparent_tag, parent_tag, child_tag):
-    """ find the first node for given gandparent tag then extract all 
-    the parent nodes and for each parent node extract the text for its 
-    child as a postgres array string
-
-    :param elem: an lxml.etree element
-    :param gandparent_tag: an xml tag for the grandparent node
-    :param parent_tag: an xml tag for the parent nodes
-    :param child_tag: an xml tag for the child node
-    :return: postgres array string (eg. {foo, bar}) or None
-    """
-    grandparent_elem = elem.find(oca_tag(grandparent_tag))
-
-    if grandparent_elem is not None:
-       return '{' + ','.join([ i.find(oca_tag(child_tag)).text for i in grandparent_elem.findall(oca_tag(parent_tag)) ]) + '}'
-    else:
-        return None
+# The start tag of an appearance in the raw xml, to count how many ids a 
+# chunk of cases needs before it's parsed
+APPEARANCE_START_PAT = re.compile(rb'<(?:[\w.-]+:)?Appearance[\s>]')
 
 
-def parse_index(case, db):
-    """ for a case parse all the values for the oca_index 
-    table and load the values into the database table
+def drop_case_rows(case, buffer):
+    """ 
+    Flag a single case for removal from all the main tables in the 
+    database. The ids are collected in the oca_deletes_staging table and 
+    deleted together when the staging tables are merged into the main 
+    ones (all other main tables reference the id in the oca_index table 
+    and the deletion cascades to those tables)
 
     :param case: an lxml.etree element for a case index
-    :param db: a Database object
+    :param buffer: a StagingBuffer object
     """
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
     row = [{
-        'indexnumberid' : IndexNumberId,
-        'court' : oca_extract(case, 'Court'),
-        'fileddate' : oca_extract(case, 'FiledDate'),
-        'propertytype' : oca_extract(case, 'PropertyType'),
-        'classification' : oca_extract(case, 'Classification'),
-        'specialtydesignationtypes' : oca_extract_array1(case, 'SpecialtyDesignations', 'SpecialtyDesignationType'),
-        'status' : oca_extract(case, 'Status'),
-        'disposeddate' : oca_extract(case, 'DisposedDate'),
-        'disposedreason' : oca_extract(case, 'DisposedReasonNoPersonallyIdentifyingInfo'),
-        'firstpaper' : oca_extract(case, 'FirstPaper'),
-        'primaryclaimtotal' : oca_extract(case, 'PrimaryClaimTotal'),
-        'dateofjurydemand' : oca_extract(case, 'DateOfJuryDemand'),
+        'indexnumberid' : case.find(INDEX_NUMBER_ID_TAG).text,
     }]
 
-    db.insert_rows(row, 'oca_index_staging')
+    buffer.write_rows(row, 'oca_deletes_staging')
 
 
-def parse_causes(case, db):
-    """ for a case parse all the values for the oca_causes
-    table and load the values into the database table
+def clear_case(case):
+    """ Free the memory used by a case once it has been parsed. Clearing 
+    the element isn't enough, because the empty element (and those of 
+    all the cases before it) stay attached to the root, so they are also 
+    removed from their parents.
 
     :param case: an lxml.etree element for a case index
-    :param db: a Database object
     """
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
-    causes = case.find(oca_tag('PrimaryClaimCauseOfActions'))
-
-    if causes is None:
-        return None
+    case.clear()
+
+    for elem in itertools.chain((case,), case.iterancestors()):
+        while elem.getprevious() is not None:
+            del elem.getparent()[0]
+
+
+class AncestorColumn:
+    """ a column source in TABLE_SPECS for a value copied from the row 
+    made from an ancestor of the row element (eg. '../../appearanceid') """
+
+    def __init__(self, path):
+        *up, self.column = path.split('/')
+        if not up or any(t != '..' for t in up):
+            raise ValueError(f"Unsupported ancestor column path: {path}")
+        self.level = len(up)
+
+
+# A column source in TABLE_SPECS for a new id taken from the ids passed to 
+# parse_case (see APPEARANCE_ID_SEQUENCE)
+NEXT_ID = object()
+
+
+# Every staging table is described by the path of tags from the case 
+# element down to the elements that become its rows (an empty path is the 
+# case itself, the one row of oca_index), and where each column comes 
+# from relative to a row element:
+#
+#   'Tag'                   text of the first child with that tag
+#   '../../Tag'             text of the first child of an ancestor
+#   ['Parent/Child']        text of every Child of the first Parent, as a list
+#   ['Parent/Item/Child']   text of the Child of every Item of the first 
+#                           Parent, as a list
+#   AncestorColumn('../../Column')
+#                           value of a column of the row made from an ancestor
+#   NEXT_ID                 a new id
+#   a function              called with the row element to get the value
+#
+# Every row also gets the indexnumberid of its case. Lists are either None 
+# (no Parent) or a list, possibly empty, for the postgres array columns.
+
+# TODO: Need to further parse the text of the decision "Highlight" field, 
+# though it's not clear what is a useful way to structure this.
+
+TABLE_SPECS = [
+    ('oca_index_staging', '', [
+        ('court', 'Court'),
+        ('fileddate', 'FiledDate'),
+        ('propertytype', 'PropertyType'),
+        ('classification', 'Classification'),
+        ('specialtydesignationtypes', ['SpecialtyDesignations/SpecialtyDesignationType']),
+        ('status', 'Status'),
+        ('disposeddate', 'DisposedDate'),
+        ('disposedreason', 'DisposedReasonNoPersonallyIdentifyingInfo'),
+        ('firstpaper', 'FirstPaper'),
+        ('primaryclaimtotal', 'PrimaryClaimTotal'),
+        ('dateofjurydemand', 'DateOfJuryDemand'),
+    ]),
+    ('oca_causes_staging', 'PrimaryClaimCauseOfActions/PrimaryClaimCauseOfAction', [
+        ('causeofactiontype', 'CauseOfActionType'),
+        ('interestfromdate', 'InterestFromDate'),
+        ('amount', 'Amount'),
+    ]),
+    ('oca_addresses_staging', 'PropertyAddresses/PropertyAddress', [
+        ('city', 'City'),
+        ('state', 'State'),
+        ('postalcode', 'PostalCode'),
+    ]),
+    ('oca_parties_staging', 'Parties/Party', [
+        ('role', 'Role'),
+        ('partytype', 'PartyType'),
+        ('representationtype', 'RepresentationType'),
+        ('undertenant', 'Undertenant'),
+    ]),
+    ('oca_events_staging', 'Events/Event', [
+        ('eventname', 'EventName'),
+        ('fileddate', 'FiledDate'),
+        ('feetype', 'FeeType'),
+        ('filingpartiesroles', ['FilingParties/FilingParty/Role']),
+        ('answertype', 'AnswerType'),
+    ]),
+    ('oca_appearances_staging', 'Appearances/Appearance', [
+        ('appearanceid', NEXT_ID),
+        ('appearancedatetime', 'AppearanceDateTime'),
+        ('appearancepurpose', 'AppearancePurpose'),
+        ('appearancereason', 'AppearanceReason'),
+        ('appearancepart', 'AppearancePart'),
+        ('motionsequence', 'MotionSequence'),
+    ]),
+    ('oca_appearance_outcomes_staging', 'Appearances/Appearance/AppearanceOutcomes/AppearanceOutcome', [
+        ('appearanceid', AncestorColumn('../../appearanceid')),
+        ('appearanceoutcometype', 'AppearanceOutcomeType'),
+        ('outcomebasedontype', 'OutcomeBasedOnType'),
+    ]),
+    ('oca_motions_staging', 'Motions/Motion', [
+        ('sequence', 'Sequence'),
+        ('motiontype', 'MotionType'),
+        ('primaryrelief', 'PrimaryRelief'),
+        ('fileddate', 'FiledDate'),
+        ('filingpartiesroles', ['FilingParties/FilingParty/Role']),
+        ('motiondecision', 'MotionDecision'),
+        ('motiondecisiondate', 'MotionDecisionDate'),
+    ]),
+    ('oca_decisions_staging', 'Decisions/Decision', [
+        ('sequence', 'Sequence'),
+        ('resultof', 'ResultOf'),
+        ('highlight', 'HighlightNoPersonallyIdentifyingInfo'),
+    ]),
+    ('oca_judgments_staging', 'Judgments/Judgment', [
+        ('sequence', 'Sequence'),
+        ('amendedfromjudgmentsequence', 'AmendedFromJudgmentSequence'),
+        ('judgmenttype', 'JudgmentType'),
+        ('fileddate', 'FiledDate'),
+        ('entereddatetime', 'EnteredDateTime'),
+        ('withpossession', 'WithPossession'),
+        ('latestjudgmentstatus', 'LatestJudgmentStatus'),
+        ('latestjudgmentstatusdate', 'LatestJudgmentStatusDate'),
+        ('totaljudgmentamount', 'TotalJudgmentAmount'),
+        ('creditorsroles', ['Creditors/Creditor/Role']),
+        ('debtorsroles', ['Debtors/Debtor/Role']),
+    ]),
+    ('oca_warrants_staging', 'Judgments/Judgment/Warrants/Warrant', [
+        ('judgmentsequence', '../../Sequence'),
+        ('sequence', 'Sequence'),
+        ('createdreason', 'CreatedReason'),
+        ('ordereddate', 'OrderedDate'),
+        ('issuancetype', 'IssuanceType'),
+        ('issuancestayeddate', 'IssuanceStayedDate'),
+        ('issuancestayeddays', 'IssuanceStayedDays'),
+        ('issueddate', 'IssuedDate'),
+        ('executiontype', 'ExecutionType'),
+        ('executionstayeddate', 'ExecutionStayedDate'),
+        ('executionstayeddays', 'ExecutionStayedDays'),
+        ('marshalrequestdate', 'MarshalRequestDate'),
+        ('marshalrequestrevieweddate', 'MarshalRequestReviewedDate'),
+        ('enforcementagency', 'EnforcementAgency'),
+        ('enforcementofficerdocketnumber', 'EnforcementOfficerDocketNumber'),
+        ('propertiesonwarrantcities', ['PropertiesOnWarrant/PropertyOnWarrant/City']),
+        ('propertiesonwarrantstates', ['PropertiesOnWarrant/PropertyOnWarrant/State']),
+        ('propertiesonwarrantpostalcodes', ['PropertiesOnWarrant/PropertyOnWarrant/PostalCode']),
+        ('amendeddate', 'AmendedDate'),
+        ('vacateddate', 'VacatedDate'),
+        ('adultprotectiveservicesnumber', 'AdultProtectiveServicesNumber'),
+        ('returneddate', 'ReturnedDate'),
+        ('returnedreason', 'ReturnedReason'),
+        ('executiondate', 'ExecutionDate'),
+    ]),
+]
+
+
+def element_text(elem):
+    return None if elem is None else elem.text
+
+
+def first_children(elem):
+    """ map each tag to the first child of an element with that tag, so 
+    that all the columns of a row are found with one pass over its children
 
-    rows = []
-    for cause in causes.iter(oca_tag('PrimaryClaimCauseOfAction')):
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'causeofactiontype' : oca_extract(cause, 'CauseOfActionType'),
-            'interestfromdate' : oca_extract(cause, 'InterestFromDate'),
-            'amount' : oca_extract(cause, 'Amount'),
-        })
-
-    if rows:
-        db.insert_rows(rows, 'oca_causes_staging')
-
-
-def parse_addresses(case, db):
-    """ for a case parse all the values for the oca_addresses
-    table and load the values into the database table
-
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
+    :param elem: an lxml.etree element
+    :return: dict of tag to lxml.etree element
     """
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
-    addresses = case.find(oca_tag('PropertyAddresses'))
-
-    if addresses is None:
-        return None
-
-    rows = []
-    for address in addresses.iter(oca_tag('PropertyAddress')):
-
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'city' : oca_extract(address, 'City'),
-            'state' : oca_extract(address, 'State'),
-            'postalcode' : oca_extract(address, 'PostalCode'),
-        })
-        
-    if rows:
-        db.insert_rows(rows, 'oca_addresses_staging')
-
-
-def parse_parties(case, db):
-    """ for a case parse all the values for the oca_parties
-    table and load the values into the database table
-
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
+    children = {}
+    for child in elem:
+        if child.tag not in children:
+            children[child.tag] = child
+    return children
+
+
+def compile_column(source):
+    """ turn the source of a column in TABLE_SPECS into a function of the 
+    row element, its first_children, the list of its ancestors (from the 
+    case down, as (element, values of the rows made from it) tuples) and 
+    the iterator of new ids, that extracts the column's value
+
+    :param source: a tag, path, list with a path, AncestorColumn, NEXT_ID 
+        or function
+    :return: function
+    """
+    if source is NEXT_ID:
+        return lambda row, children, ancestors, ids: next(ids)
+
+    if isinstance(source, AncestorColumn):
+        level, column = source.level, source.column
+        return lambda row, children, ancestors, ids: ancestors[-level][1][column]
+
+    if callable(source):
+        return lambda row, children, ancestors, ids: source(row)
+
+    if isinstance(source, list):
+        tags = [oca_tag(t) for t in source[0].split('/')]
+        if len(tags) == 2:
+            parent_tag, item_tag = tags
+            def extract_array(row, children, ancestors, ids):
+                parent = children.get(parent_tag)
+                if parent is None:
+                    return None
+                return [ i.text for i in parent.iterchildren(item_tag) ]
+            return extract_array
+        if len(tags) == 3:
+            parent_tag, item_tag, child_tag = tags
+            def extract_nested_array(row, children, ancestors, ids):
+                parent = children.get(parent_tag)
+                if parent is None:
+                    return None
+                return [ element_text(i.find(child_tag)) for i in parent.iterchildren(item_tag) ]
+            return extract_nested_array
+        raise ValueError(f"Unsupported array column path: {source[0]}")
+
+    *up, tag = source.split('/')
+    if any(t != '..' for t in up):
+        raise ValueError(f"Unsupported column path: {source}")
+    tag = oca_tag(tag)
+
+    if up:
+        level = len(up)
+        def extract_ancestor_text(row, children, ancestors, ids):
+            return element_text(ancestors[-level][0].find(tag))
+        return extract_ancestor_text
+
+    def extract_text(row, children, ancestors, ids):
+        return element_text(children.get(tag))
+    return extract_text
+
+
+def compile_table_specs(specs):
+    """ build a tree of tags from the row paths of all the table specs, 
+    so that one walk down a case finds the rows for every table. Each node 
+    is a dict with the tables whose rows are at that node (as a list of 
+    (table_name, [(column, extractor), ...])) and the nodes below it.
+
+    :param specs: list of (table_name, row_path, columns) like TABLE_SPECS
+    :return: dict for the node of the case element
     """
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
+    root = {'tables': [], 'children': {}}
 
-    parties = case.find(oca_tag('Parties'))
+    for table_name, row_path, columns in specs:
+        node = root
+        for tag in filter(None, row_path.split('/')):
+            node = node['children'].setdefault(oca_tag(tag), {'tables': [], 'children': {}})
 
-    if parties is None:
-        return None
+        compiled = [ (column, compile_column(source)) for column, source in columns ]
+        node['tables'].append((table_name, compiled))
 
-    rows = []
-    for party in parties.iter(oca_tag('Party')):
+    return root
 
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'role' : oca_extract(party, 'Role'),
-            'partytype' : oca_extract(party, 'PartyType'),
-            'representationtype' : oca_extract(party, 'RepresentationType'),
-            'undertenant' : oca_extract(party, 'Undertenant'),
-        })
 
-    if rows:
-        db.insert_rows(rows, 'oca_parties_staging')
+CASE_NODE = compile_table_specs(TABLE_SPECS)
+STAGING_TABLES = [ table_name for table_name, row_path, columns in TABLE_SPECS ]
 
 
-def parse_events(case, db):
-    """ for a case parse all the values for the oca_events
-    table and load the values into the database table
+def extract_rows(elem, children, node, ancestors, index_number_id, ids, rows):
+    """ add the rows of every table found at this node of the table spec 
+    tree, then walk down to the children that have tables below them
 
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
+    :param elem: an lxml.etree element
+    :param children: the first_children of elem
+    :param node: the compiled table spec node for elem
+    :param ancestors: list of (element, values) for the elements above 
+        elem, from the case down
+    :param index_number_id: the id of the case
+    :param ids: an iterator of new appearance ids
+    :param rows: dict of table name to list of rows, that is added to
     """
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
-    events = case.find(oca_tag('Events'))
-
-    if events is None:
-        return None
-
-    rows = []
-    for event in events.iter(oca_tag('Event')):
-
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'eventname' : oca_extract(event, 'EventName'),
-            'fileddate' : oca_extract(event, 'FiledDate'),
-            'feetype' : oca_extract(event, 'FeeType'),
-            'filingpartiesroles' : oca_extract_array2(event, 'FilingParties', 'FilingParty', 'Role'),
-            'answertype' : oca_extract(event, 'AnswerType'),
-        })
-
-    if rows:
-        db.insert_rows(rows, 'oca_events_staging')
-
+    values = {}
+    for table_name, columns in node['tables']:
+        row = {'indexnumberid' : index_number_id}
+        for column, extract in columns:
+            row[column] = extract(elem, children, ancestors, ids)
+        rows[table_name].append(row)
+        values.update(row)
+
+    if not node['children']:
+        return
 
-def appearance_outcome_to_json(elem):
-    appearanceoutcometype_val = '"' + elem.find(oca_tag('AppearanceOutcomeType')).text + '"'
-    outcomebasedontype_val = '"' + elem.find(oca_tag('OutcomeBasedOnType')).text + '"' if elem.find(oca_tag('OutcomeBasedOnType')) is not None else 'null'
+    ancestors.append((elem, values))
+    for child in elem:
+        child_node = node['children'].get(child.tag)
+        if child_node is not None:
+            extract_rows(child, first_children(child), child_node, ancestors, index_number_id, ids, rows)
+    ancestors.pop()
 
-    return f"{{\"appearanceoutcometype\":{appearanceoutcometype_val},\"outcomebasedontype\":{outcomebasedontype_val}}}"    
 
+def parse_case(case, buffer, ids):
+    """ for a case, remove it from the database if it already exists, 
+    then determine if it needs to be deleted permantly, if not then 
+    parse all the values and insert the values into all the database table
 
-def parse_appearances(case, db):
-    """ for a case parse all the values for the oca_appearances
-    table and load the values into the database table
+    All the tables are filled in a single walk over the case, following 
+    the compiled TABLE_SPECS.
 
     :param case: an lxml.etree element for a case index
-    :param db: a Database object
+    :param buffer: a StagingBuffer object
+    :param ids: an iterator of new appearance ids
     """
+    children = first_children(case)
 
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
-    appearances = case.find(oca_tag('Appearances'))
-
-    if appearances is None:
-        return None
-
-    rows = []
-    for appearance in appearances.iter(oca_tag('Appearance')):
-
-        appearance_outcomes = appearance.find(oca_tag('AppearanceOutcomes'))        
-
-        if appearance_outcomes is not None:
-            AppearanceOutcomes = '[' + ','.join([ appearance_outcome_to_json(i) for i in appearance_outcomes.iter(oca_tag('AppearanceOutcome')) ]) + ']'
-        else:
-            AppearanceOutcomes = '[]'
+    # If this case is flagged for removal, skip the parsing steps
+    if DELETE_TAG in children:
+        # Remove the case from all tables if it already exists
+        drop_case_rows(case, buffer)
+        return
 
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'appearancedatetime' : oca_extract(appearance, 'AppearanceDateTime'),
-            'appearancepurpose' : oca_extract(appearance, 'AppearancePurpose'),
-            'appearancereason' : oca_extract(appearance, 'AppearanceReason'),
-            'appearancepart' : oca_extract(appearance, 'AppearancePart'),
-            'motionsequence' : oca_extract(appearance, 'MotionSequence'),
-            'appearanceoutcomes' : AppearanceOutcomes,
-        })
+    rows = collections.defaultdict(list)
+    index_number_id = children[INDEX_NUMBER_ID_TAG].text
+    extract_rows(case, children, CASE_NODE, [], index_number_id, ids, rows)
 
-    if rows:
-        db.insert_rows(rows, 'oca_appearances_staging')
+    for table_name in STAGING_TABLES:
+        if rows[table_name]:
+            buffer.write_rows(rows[table_name], table_name)
 
 
-def parse_motions(case, db):
-    """ for a case parse all the values for the oca_motions
-    table and load the values into the database table
+def count_appearances(chunk):
+    """ count the appearances in the raw bytes of some cases. This can 
+    only overcount (eg. if a case flagged for deletion still lists its 
+    appearances), which just leaves gaps in the ids.
 
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
+    :param chunk: bytes for some cases
+    :return: int
     """
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
-    motions = case.find(oca_tag('Motions'))
-
-    if motions is None:
-        return None
+    return len(APPEARANCE_START_PAT.findall(chunk))
 
-    rows = []
-    for motion in motions.iter(oca_tag('Motion')):
 
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'sequence' : oca_extract(motion, 'Sequence'),
-            'motiontype' : oca_extract(motion, 'MotionType'),
-            'primaryrelief' : oca_extract(motion, 'PrimaryRelief'),
-            'fileddate' : oca_extract(motion, 'FiledDate'),
-            'filingpartiesroles' : oca_extract_array2(motion, 'FilingParties', 'FilingParty', 'Role'),
-            'motiondecision' : oca_extract(motion, 'MotionDecision'),
-            'motiondecisiondate' : oca_extract(motion, 'MotionDecisionDate'),
-        })
+def parse_chunk(chunk, huge_tree=False):
+    """ parse every case in a small xml document (a chunk of the full 
+    extract made by CaseSplitter) into COPY-ready text for each staging 
+    table. This runs in the worker processes of parse_file, so the 
+    appearance ids are reserved beforehand by the main process.
 
-    if rows:
-        db.insert_rows(rows, 'oca_motions_staging')
-
-
-def parse_decisions(case, db):
-    """ for a case parse all the values for the oca_decisions
-    table and load the values into the database table
-
-    :param case: an lxml.etree element for a case index
+    :param chunk: tuple of bytes for a well-formed xml document and a list 
+        of ids for its appearances
+    :param huge_tree: allow very deep trees and very large text nodes
+    :return: list of (table_name, columns, text, rows) tuples, the number 
+        of cases, and the peak memory use of the worker process in bytes
+    """
+    xml, appearance_ids = chunk
+    ids = iter(appearance_ids)
+    # The whole chunk is drained at the end, so the buffer must never flush 
+    # (it has no database to flush to) however many rows the chunk has
+    buffer = StagingBuffer(None, max_rows=float('inf'), max_bytes=float('inf'))
+
+    context = etree.iterparse(io.BytesIO(xml), tag=INDEX_TAG, huge_tree=huge_tree)
+    for action, case in context:
+        parse_case(case, buffer, ids)
+        clear_case(case)
+        buffer.end_case()
+
+    return buffer.drain(), buffer.cases, peak_rss()
+
+
+def parse_file(xml_file, db, max_rows=100000, max_bytes=64 * 1024 * 1024, 
+               workers=1, cases_per_chunk=1000, huge_tree=False, max_rss=None, 
+               appearance_ids=None, progress=None, checkpoint=None, skip_cases=0):
+    """ parse every case in the xml file into the staging tables. Rows 
+    are buffered across cases and loaded in bulk whenever the buffer 
+    reaches max_rows rows or max_bytes bytes, and once more at the end 
+    of the file (or on error) so nothing parsed is lost.
+
+    With more than one worker the file is split into chunks of cases 
+    that are parsed in a pool of processes. The chunks are loaded in the 
+    same order as the file, so the staging tables end up exactly the 
+    same as with a single process.
+
+    Memory use stays constant however big the file is, and every so often 
+    it's checked against max_rss. If it's over, the buffer is flushed and 
+    if that doesn't help a MemoryError is raised. The peak memory use is 
+    printed at the end.
+
+    Appearances are given ids from APPEARANCE_ID_SEQUENCE, reserved in 
+    blocks, unless an iterator of ids is passed in.
+
+    The progress bar counts cases (or chunks), unless progress gives the 
+    total number of bytes to read and a function that returns how many 
+    have been read so far (eg. the size of the zip file and the tell() 
+    of the file it's read from), which also gives an ETA.
+
+    To resume a file that was interrupted, the cases already loaded can 
+    be skipped over without parsing them. Every time rows are loaded, the 
+    checkpoint function is called with the number of cases loaded so far 
+    (counting the skipped ones) before they're committed, so it can record 
+    that number in the same transaction.
+
+    :param xml_file: a file-like object for the xml extract
     :param db: a Database object
+    :param max_rows: number of buffered rows that triggers a flush
+    :param max_bytes: size of buffered rows in bytes that triggers a flush
+    :param workers: number of processes to parse with
+    :param cases_per_chunk: number of cases sent to a worker at a time
+    :param huge_tree: allow very deep trees and very large text nodes
+    :param max_rss: memory ceiling for the main process in bytes (or None)
+    :param appearance_ids: iterator of ids for the appearances (or None)
+    :param progress: (total bytes, function returning bytes read) or None
+    :param checkpoint: function called with the number of cases loaded, 
+        in the same transaction as their rows (or None)
+    :param skip_cases: number of cases at the start of the file to skip
+    :return: dict of the number of rows loaded into each staging table
     """
+    if appearance_ids is None:
+        appearance_ids = db.sequence_values(APPEARANCE_ID_SEQUENCE)
+
+    def progress_bar(iterable):
+        if progress is None:
+            return frogress.bar(iterable)
+        total, position = progress
+        return frogress.TransferBar(iterable, steps=total, step_callback=position)
+
+    def check_buffer_memory(buffer):
+        if max_rss and current_rss() > max_rss:
+            buffer.flush()
+            check_memory(max_rss)
+
+    # The buffer only counts the cases it has seen itself
+    def save_checkpoint(cases):
+        checkpoint(skip_cases + cases)
+
+    buffer_args = (max_rows, max_bytes, save_checkpoint if checkpoint else None)
+
+    # The cases are skipped by finding where they end in the raw xml, which 
+    # is much faster than parsing them
+    if skip_cases:
+        splitter = CaseSplitter(xml_file)
+        print(f"   - Skipped {splitter.skip(skip_cases)} cases already loaded")
+
+    if workers > 1:
+        if not skip_cases:
+            splitter = CaseSplitter(xml_file)
+        chunks = (
+            (splitter.wrap(c), list(itertools.islice(appearance_ids, count_appearances(c))))
+            for c in splitter.chunks(cases_per_chunk)
+        )
+        parse = functools.partial(parse_chunk, huge_tree=huge_tree)
+
+        # The workers aren't children of this process (see process_pool), 
+        # so they report their own peak memory use with every chunk
+        workers_peak_rss = 0
+
+        with StagingBuffer(db, *buffer_args) as buffer:
+            with process_pool(workers) as pool:
+                for contents, cases, chunk_peak_rss in progress_bar(bounded_map(pool, parse, chunks, workers * 2)):
+                    buffer.load(contents)
+                    buffer.end_case(cases)
+                    workers_peak_rss = max(workers_peak_rss, chunk_peak_rss)
+                    check_buffer_memory(buffer)
+    else:
+        if skip_cases:
+            xml_file = splitter.remainder()
+        context = etree.iterparse(xml_file, tag=INDEX_TAG, huge_tree=huge_tree)
 
-    # TODO: Need to further parse the text of the "Highlight" field, 
-    # though it's not clear what is a useful way to structure this.
+        with StagingBuffer(db, *buffer_args) as buffer:
+            for i, (action, case) in enumerate(progress_bar(context)):
 
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
+                # If case already exists in DB delete it, 
+                # if we have delete instructions don't re-add it, 
+                # otherwise parse the case and insert it into the various tables.
+                parse_case(case, buffer, appearance_ids)
 
-    decisions = case.find(oca_tag('Decisions'))
+                # Clear the case element (and the ones before it) to free memory
+                clear_case(case)
 
-    if decisions is None:
-        return None
+                # Rows are loaded into the database in bulk once enough have been collected
+                buffer.end_case()
 
-    rows = []
-    for decision in decisions.iter(oca_tag('Decision')):
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'sequence' : oca_extract(decision, 'Sequence'),
-            'resultof' : oca_extract(decision, 'ResultOf'),
-            'highlight' : oca_extract(decision, 'HighlightNoPersonallyIdentifyingInfo'),
-        })
+                if i % 1000 == 0:
+                    check_buffer_memory(buffer)
 
-    if rows:
-        db.insert_rows(rows, 'oca_decisions_staging')
+    print(f"\n   - Peak memory use: {peak_rss() / 1e6:.0f} MB", end='')
+    if workers > 1:
+        print(f" (workers: {workers_peak_rss / 1e6:.0f} MB)", end='')
 
+    return dict(buffer.loaded)
 
-def parse_judgments(case, db):
-    """ for a case parse all the values for the oca_judgments
-    table and load the values into the database table
 
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
+class CsvTables:
+    """
+    Takes the place of a Database in parse_file to write the staging tables 
+    to a CSV file each in a directory instead of loading them, so that a 
+    file can be parsed without a database (eg. for a quick look or to build 
+    the tables somewhere else). The files are named after the main tables 
+    (eg. oca_index.csv, plus oca_deletes.csv for the cases flagged for 
+    deletion) and have a header row, so they can be loaded later with 
+    COPY ... FROM ... WITH CSV HEADER. Appearance ids start from 1.
     """
 
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
-    judgments = case.find(oca_tag('Judgments'))
+    def __init__(self, out_dir, buffer_size=1024 * 1024):
+        os.makedirs(out_dir, exist_ok=True)
+        self.paths = {}
+        self.files = {}
+        self.writers = {}
 
-    if judgments is None:
-        return None
+        # The columns are in the same order as the rows made by parse_case
+        tables = [
+            (table_name, ['indexnumberid'] + [ column for column, source in columns ]) 
+            for table_name, row_path, columns in TABLE_SPECS
+        ] + [('oca_deletes_staging', ['indexnumberid'])]
 
-    rows = []
-    for judgment in judgments.iter(oca_tag('Judgment')):
+        for table_name, columns in tables:
+            path = os.path.join(out_dir, re.sub(r'_staging$', '', table_name) + '.csv')
+            f = open(path, 'w', newline='', encoding='utf-8', buffering=buffer_size)
+            self.writers[table_name] = csv.writer(f)
+            self.writers[table_name].writerow(columns)
+            self.paths[table_name] = path
+            self.files[table_name] = f
 
-        rows.append({
-            'indexnumberid' : IndexNumberId,
-            'sequence' : oca_extract(judgment, 'Sequence'),
-            'amendedfromjudgmentsequence' : oca_extract(judgment, 'AmendedFromJudgmentSequence'),
-            'judgmenttype' : oca_extract(judgment, 'JudgmentType'),
-            'fileddate' : oca_extract(judgment, 'FiledDate'),
-            'entereddatetime' : oca_extract(judgment, 'EnteredDateTime'),
-            'withpossession' : oca_extract(judgment, 'WithPossession'),
-            'latestjudgmentstatus' : oca_extract(judgment, 'LatestJudgmentStatus'),
-            'latestjudgmentstatusdate' : oca_extract(judgment, 'LatestJudgmentStatusDate'),
-            'totaljudgmentamount' : oca_extract(judgment, 'TotalJudgmentAmount'),
-            'creditorsroles' : oca_extract_array2(judgment, 'Creditors', 'Creditor', 'Role'),
-            'debtorsroles' : oca_extract_array2(judgment, 'Debtors', 'Debtor', 'Role'),
-        })
 
-    if rows:
-        db.insert_rows(rows, 'oca_judgments_staging')
+    def __enter__(self):
+        return self
 
 
-def parse_warrants(case, db):
-    """ for a case parse all the values for the oca_warrants
-    table and load the values into the database table
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
 
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
-    """
-
-    IndexNumberId = case.find(oca_tag('IndexNumberId')).text
-
-    judgments = case.find(oca_tag('Judgments'))
-
-    if judgments is None:
-        return None
-
-    for judgment in judgments.iter(oca_tag('Judgment')):
-
-        JudgmentSequence = oca_extract(judgment, 'Sequence')
-
-        warrants = judgment.find(oca_tag('Warrants'))
-
-        if warrants is None:
-            return None
-
-        rows = []
-        for warrant in warrants.iter(oca_tag('Warrant')):
-
-            rows.append({
-                'indexnumberid' : IndexNumberId,
-                'judgmentsequence' : JudgmentSequence,
-                'sequence' : oca_extract(warrant, 'Sequence'),
-                'createdreason' : oca_extract(warrant, 'CreatedReason'),
-                'ordereddate' : oca_extract(warrant, 'OrderedDate'),
-                'issuancetype' : oca_extract(warrant, 'IssuanceType'),
-                'issuancestayeddate' : oca_extract(warrant, 'IssuanceStayedDate'),
-                'issuancestayeddays' : oca_extract(warrant, 'IssuanceStayedDays'),
-                'issueddate' : oca_extract(warrant, 'IssuedDate'),
-                'executiontype' : oca_extract(warrant, 'ExecutionType'),
-                'executionstayeddate' : oca_extract(warrant, 'ExecutionStayedDate'),
-                'executionstayeddays' : oca_extract(warrant, 'ExecutionStayedDays'),
-                'marshalrequestdate' : oca_extract(warrant, 'MarshalRequestDate'),
-                'marshalrequestrevieweddate' : oca_extract(warrant, 'MarshalRequestReviewedDate'),
-                'enforcementagency' : oca_extract(warrant, 'EnforcementAgency'),
-                'enforcementofficerdocketnumber' : oca_extract(warrant, 'EnforcementOfficerDocketNumber'),
-                'propertiesonwarrantcities' : oca_extract_array2(warrant, 'PropertiesOnWarrant', 'PropertyOnWarrant', 'City'),
-                'propertiesonwarrantstates' : oca_extract_array2(warrant, 'PropertiesOnWarrant', 'PropertyOnWarrant', 'State'),
-                'propertiesonwarrantpostalcodes' : oca_extract_array2(warrant, 'PropertiesOnWarrant', 'PropertyOnWarrant', 'PostalCode'),
-                'amendeddate' : oca_extract(warrant, 'AmendedDate'),
-                'vacateddate' : oca_extract(warrant, 'VacatedDate'),
-                'adultprotectiveservicesnumber' : oca_extract(warrant, 'AdultProtectiveServicesNumber'),
-                'returneddate' : oca_extract(warrant, 'ReturnedDate'),
-                'returnedreason' : oca_extract(warrant, 'ReturnedReason'),
-                'executiondate' : oca_extract(warrant, 'ExecutionDate'),
-            })
-
-        if rows:
-            db.insert_rows(rows, 'oca_warrants_staging')
-
-
-def parse_case(case, db):
-    """ for a case, remove it from the database if it already exists, 
-    then determine if it needs to be deleted permantly, if not then 
-    parse all the values and insert the values into all the database table
-
-    :param case: an lxml.etree element for a case index
-    :param db: a Database object
-    """
-
-    # If this case is flagged for removal, skip the parsing steps
-    if is_case_to_delete(case):
-        # Remove the case from all tables if it already exists
-        drop_case_rows(case, db)
-        return
 
-    parse_index(case, db)
-    parse_causes(case, db)
-    parse_addresses(case, db)
-    parse_parties(case, db)
-    parse_events(case, db)
-    parse_appearances(case, db)
-    parse_motions(case, db)
-    parse_decisions(case, db)
-    parse_judgments(case, db)
-    parse_warrants(case, db)
+    def sequence_values(self, sequence):
+        """ there are no other rows to avoid, so the ids just count up from 1 """
+        return itertools.count(1)
 
 
-def parse_file(xml_file, db):
+    def copy_writers(self, writers):
+        """ writes the rows buffered in each CopyWriter to the CSV file for its table """
+        for writer in writers:
+            if writer.rows:
+                self.writers[writer.table_name].writerows(copy_text_rows(writer.buffer.getvalue()))
+                writer.clear()
 
-    context = etree.iterparse(xml_file, tag=oca_tag('Index'))
 
-    for action, case in frogress.bar(context):
+    def commit(self):
+        for f in self.files.values():
+            f.flush()
 
-        # If case already exists in DB delete it, 
-        # if we have delete instructions don't re-add it, 
-        # otherwise parse the case and insert it into the various tables.
-        parse_case(case, db)
 
-        # Clear the case element to free memory
-        case.clear()
+    def close(self):
+        for f in self.files.values():
+            f.close()
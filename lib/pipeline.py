@@ -0,0 +1,94 @@
+import collections
+import multiprocessing
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Marks the end of the items in the queues below
+DONE = object()
+
+# Worker processes are started from a clean server process rather than 
+# forked from this one, which may have other threads running (eg. SFTP 
+# downloads) that hold locks a forked child would inherit and never release
+START_METHOD = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+
+
+def process_pool(workers):
+    """
+    A ProcessPoolExecutor whose worker processes aren't forked from this 
+    one. Everything sent to the workers must be picklable and importable.
+
+    :param workers: number of worker processes
+    """
+    try:
+        return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(START_METHOD))
+    except TypeError:
+        # Before Python 3.7 the pool always uses the default start method
+        multiprocessing.set_start_method(START_METHOD, force=True)
+        return ProcessPoolExecutor(workers)
+
+
+def bounded_map(executor, func, iterable, max_pending):
+    """
+    Like executor.map, but only submits a few items ahead of the results 
+    being consumed, so a huge (or lazy) iterable is never read into memory 
+    all at once. Results are yielded in the same order as the iterable.
+
+    :param executor: a concurrent.futures executor
+    :param func: function to call on every item
+    :param iterable: items to process
+    :param max_pending: maximum number of submitted but unconsumed items
+    """
+    pending = collections.deque()
+
+    for item in iterable:
+        pending.append(executor.submit(func, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+class BackgroundQueue:
+    """
+    Calls a function on every item put on the queue in a background thread, 
+    in the same order the items were put. The queue is bounded, so put() 
+    waits whenever the thread falls too far behind. The first error is 
+    raised again by put() or join().
+    """
+
+    def __init__(self, func, maxsize=2):
+        self.func = func
+        self.queue = queue.Queue(maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is DONE:
+                return
+            # After an error keep emptying the queue so put() never blocks
+            if self.error is None:
+                try:
+                    self.func(item)
+                except Exception as e:
+                    self.error = e
+
+
+    def put(self, item):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(item)
+
+
+    def join(self):
+        """ wait for every item to be processed """
+        self.queue.put(DONE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
@@ -1,9 +1,13 @@
 import logging
 import boto3
+import collections
+import hashlib
 import os
 import re
+import time
 
-from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from botocore.exceptions import BotoCoreError, ClientError
 from botocore.client import Config
 
 
@@ -18,7 +22,7 @@ def s3_client(aws_id, aws_key):
 	return s3
 
 
-def put_object(s3_client, dest_bucket_name, dest_object_name, src_data, content_type, cache_control=''):
+def put_object(s3_client, dest_bucket_name, dest_object_name, src_data, content_type, cache_control='', metadata=None):
 	"""Add an object to an Amazon S3 bucket
 
 	The src_data argument must be of type bytes or a string that references
@@ -30,6 +34,7 @@ def put_object(s3_client, dest_bucket_name, dest_object_name, src_data, content_
 	:param src_data: bytes of data or string reference to file spec
 	:param content_type: string to set for Content-Type header on file
 	:param cache_control: string to set for Cache-Control header on file (if not provided, header not set)
+	:param metadata: dict of user metadata to store with the object (optional)
 	:return: True if src_data was added to dest_bucket/dest_object, otherwise
 	False
 	"""
@@ -61,6 +66,9 @@ def put_object(s3_client, dest_bucket_name, dest_object_name, src_data, content_
 	if cache_control != '':
 		kwargs['CacheControl'] = cache_control
 
+	if metadata:
+		kwargs['Metadata'] = metadata
+
 	try:
 		s3_client.put_object(**kwargs)
 	except ClientError as e:
@@ -111,11 +119,175 @@ def get_matching_s3_keys(s3_client, bucket, prefix='', pattern=''):
             break
 
 
+def file_digest(file_path, algorithm='sha256', block_size=1024 * 1024):
+	""" hex digest of the contents of a local file """
+	digest = hashlib.new(algorithm)
+	with open(file_path, 'rb') as f:
+		for block in iter(lambda: f.read(block_size), b''):
+			digest.update(block)
+	return digest.hexdigest()
+
+
+class MultipartUpload:
+	"""
+	Uploads a single object to S3 in parts, several parts at a time, 
+	retrying any part that fails. Data is written to it like a file, so 
+	it can also be used to upload a stream that never lands on disk.
+	"""
+
+	def __init__(self, s3_client, bucket, key, content_type, cache_control='', 
+				 part_size=64 * 1024 * 1024, max_concurrency=8, max_attempts=5, metadata=None):
+		self.s3_client = s3_client
+		self.bucket = bucket
+		self.key = key
+		self.part_size = part_size
+		self.max_concurrency = max_concurrency
+		self.max_attempts = max_attempts
+
+		kwargs = {'Bucket': bucket, 'Key': key, 'ContentType': content_type}
+		if cache_control != '':
+			kwargs['CacheControl'] = cache_control
+		if metadata:
+			kwargs['Metadata'] = metadata
+
+		self.upload_id = s3_client.create_multipart_upload(**kwargs)['UploadId']
+		self.pool = ThreadPoolExecutor(max_concurrency)
+		self.pending = collections.deque()
+		self.parts = []
+		self.buffer = bytearray()
+		self.bytes = 0
+		self.start = time.time()
+
+
+	def __enter__(self):
+		return self
+
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.close()
+		else:
+			self.abort()
+
+
+	def writable(self):
+		return True
+
+
+	def write(self, data):
+		self.buffer += data
+		self.bytes += len(data)
+		while len(self.buffer) >= self.part_size:
+			self.submit_part(bytes(self.buffer[:self.part_size]))
+			del self.buffer[:self.part_size]
+		return len(data)
+
+
+	def flush(self):
+		pass
+
+
+	def write_file(self, file_path):
+		"""
+		Upload a local file as the parts of the object. Each part is only 
+		read from the file when it's uploaded, so at most max_concurrency 
+		parts are in memory at once.
+		"""
+		if self.buffer or self.parts or self.pending:
+			raise RuntimeError(f"Data was already written to the upload of {self.key}")
+
+		size = os.path.getsize(file_path)
+		for offset in range(0, size, self.part_size):
+			self.submit_part((file_path, offset, min(self.part_size, size - offset)))
+		self.bytes += size
+
+
+	def submit_part(self, data):
+		"""
+		Upload the next part in the background, waiting first if 
+		max_concurrency parts are already being uploaded
+
+		:param data: bytes of the part, or a (file_path, offset, length) 
+			tuple for a part of a local file
+		"""
+		while len(self.pending) >= self.max_concurrency:
+			self.parts.append(self.pending.popleft().result())
+
+		part_number = len(self.parts) + len(self.pending) + 1
+		self.pending.append(self.pool.submit(self.upload_part, part_number, data))
+
+
+	def upload_part(self, part_number, data):
+		""" upload a single part, retrying with backoff if it fails """
+		if isinstance(data, tuple):
+			file_path, offset, length = data
+			with open(file_path, 'rb') as f:
+				f.seek(offset)
+				data = f.read(length)
+
+		for attempt in range(1, self.max_attempts + 1):
+			try:
+				resp = self.s3_client.upload_part(
+					Bucket=self.bucket, 
+					Key=self.key, 
+					UploadId=self.upload_id, 
+					PartNumber=part_number, 
+					Body=data
+				)
+				return {'PartNumber': part_number, 'ETag': resp['ETag']}
+			except (BotoCoreError, ClientError) as e:
+				if attempt == self.max_attempts:
+					raise
+				logging.warning(f"Retrying part {part_number} of {self.key} after error: {e}")
+				time.sleep(2 ** attempt)
+
+
+	def close(self):
+		""" upload the last part, wait for all parts and complete the upload """
+		try:
+			# S3 needs at least one part, even for an empty object
+			if self.buffer or not (self.parts or self.pending):
+				self.submit_part(bytes(self.buffer))
+				self.buffer = bytearray()
+
+			while self.pending:
+				self.parts.append(self.pending.popleft().result())
+
+			self.s3_client.complete_multipart_upload(
+				Bucket=self.bucket, 
+				Key=self.key, 
+				UploadId=self.upload_id, 
+				MultipartUpload={'Parts': self.parts}
+			)
+		except Exception:
+			self.abort()
+			raise
+		finally:
+			self.pool.shutdown()
+
+		seconds = max(time.time() - self.start, 0.001)
+		print(f"  {self.key}: {self.bytes / 1e6:.1f} MB in {seconds:.1f}s ({self.bytes / 1e6 / seconds:.1f} MB/s)")
+
+
+	def abort(self):
+		""" cancel the upload so S3 discards any parts already uploaded """
+		for future in self.pending:
+			future.cancel()
+		self.pool.shutdown()
+		self.s3_client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+
+
 class S3:
 	"""AWS S3 client for getting/putting objects to/from oca-data bucket"""
 
-	def __init__(self, aws_id, aws_key):
+	def __init__(self, aws_id, aws_key, part_size=64 * 1024 * 1024, max_concurrency=8, 
+				 max_attempts=5, max_files=4, stream_concurrency=2):
 		self.s3 = s3_client(aws_id, aws_key)
+		self.part_size = part_size
+		self.max_concurrency = max_concurrency
+		self.stream_concurrency = stream_concurrency
+		self.max_attempts = max_attempts
+		self.max_files = max_files
 
 
 	def download_file(self, object_name, file_path):
@@ -124,23 +296,157 @@ class S3:
 		self.s3.download_file('oca-data', object_name, file_path)
 
 
-	def upload_file(self, object_name, file_path):
+	def object_etag(self, object_name):
+		""" return the ETag of an object, or None if it doesn't exist """
+		try:
+			return self.s3.head_object(Bucket='oca-data', Key=object_name)['ETag']
+		except ClientError as e:
+			if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+				return None
+			raise
+
+
+	def has_file(self, object_name, file_path, sha256=None):
+		"""
+		Whether the bucket already has an object with the same contents as 
+		a local file. Files uploaded by upload_files with skip_existing have 
+		their sha256 in the object's metadata. Older objects uploaded in a 
+		single part can still be compared by their ETag, which is the md5 of 
+		their contents.
+
+		:param sha256: sha256 of the local file, if it's already known
+		"""
+		try:
+			head = self.s3.head_object(Bucket='oca-data', Key=object_name)
+		except ClientError as e:
+			if e.response['Error']['Code'] in ('404', 'NoSuchKey'):
+				return False
+			raise
+
+		if head['ContentLength'] != os.path.getsize(file_path):
+			return False
 
-		ext = os.path.splitext(file_path)[1]
+		if 'sha256' in head.get('Metadata', {}):
+			return head['Metadata']['sha256'] == (sha256 or file_digest(file_path))
+
+		etag = head['ETag'].strip('"')
+		return '-' not in etag and etag == file_digest(file_path, 'md5')
+
+
+	def read_object(self, object_name):
+		""" return the contents of an object as bytes, or None if it doesn't exist """
+		try:
+			return self.s3.get_object(Bucket='oca-data', Key=object_name)['Body'].read()
+		except ClientError as e:
+			if e.response['Error']['Code'] == 'NoSuchKey':
+				return None
+			raise
+
+
+	def content_type(self, object_name):
+
+		ext = os.path.splitext(object_name)[1]
 		content_type = {
 			'.csv': 'text/csv',
+			'.json': 'application/json',
+			'.gz': 'application/gzip',
+			'.zst': 'application/zstd',
+			'.parquet': 'application/vnd.apache.parquet',
 			'.txt': 'text/plain',
 			'.svg': 'image/svg+xml',
 			'.png': 'image/png',
 			'.zip': 'application/zip',
-			'.dump': 'application/pgp-signature'
+			'.dump': 'application/pgp-signature',
+			'.tar': 'application/x-tar'
 		}[ext]
 
 		# date-updated image needs to have no-cache to be used in github readme
 		cache_control = 'no-cache' if content_type == 'image/png' else ''
 
-		# Put the object into the bucket
-		put_object(self.s3, 'oca-data', object_name, file_path, content_type, cache_control)
+		return content_type, cache_control
+
+
+	def open_upload(self, object_name, metadata=None, max_concurrency=None):
+		"""
+		Start a multipart upload to the bucket that data can be written to 
+		like a file. The upload is completed when it's closed.
+
+		Every part being uploaded from a stream is held in memory, so by 
+		default streams only upload stream_concurrency parts at a time 
+		(several tables are streamed at once when they're exported).
+		"""
+		content_type, cache_control = self.content_type(object_name)
+
+		return MultipartUpload(
+			self.s3, 'oca-data', object_name, content_type, cache_control, 
+			self.part_size, max_concurrency or self.stream_concurrency, self.max_attempts, metadata
+		)
+
+
+	def upload_file(self, object_name, file_path, metadata=None):
+		"""
+		Upload a file to the bucket, in parallel parts if it's larger than 
+		a single part. Raises an error if the upload fails.
+		"""
+		content_type, cache_control = self.content_type(file_path)
+
+		if os.path.getsize(file_path) <= self.part_size:
+			# Put the object into the bucket
+			if not put_object(self.s3, 'oca-data', object_name, file_path, content_type, cache_control, metadata):
+				raise RuntimeError(f"Failed to upload {file_path} to {object_name}")
+			return
+
+		with self.open_upload(object_name, metadata, self.max_concurrency) as upload:
+			upload.write_file(file_path)
+
+
+	def upload_new_file(self, object_name, file_path):
+		"""
+		Upload a file with its sha256 in the object's metadata, unless the 
+		bucket already has the same contents under that name
+
+		:return: True if the file was uploaded
+		"""
+		sha256 = file_digest(file_path)
+		if self.has_file(object_name, file_path, sha256):
+			return False
+
+		self.upload_file(object_name, file_path, {'sha256': sha256})
+		return True
+
+
+	def upload_files(self, files, skip_existing=False):
+		"""
+		Upload many files at once. Every upload is attempted, then an 
+		error listing all the files that failed is raised.
+
+		:param files: list of (object_name, file_path) tuples
+		:param skip_existing: don't upload files the bucket already has 
+			(see upload_new_file)
+		:return: list of the object names that were uploaded
+		"""
+		upload = self.upload_new_file if skip_existing else self.upload_file
+
+		with ThreadPoolExecutor(self.max_files) as pool:
+			futures = [(f, pool.submit(upload, *f)) for f in files]
+
+		failed = []
+		uploaded = []
+		for (object_name, file_path), future in futures:
+			try:
+				if future.result() is False:
+					print('-', object_name, '(unchanged)')
+					continue
+				uploaded.append(object_name)
+				print('-', object_name)
+			except Exception as e:
+				logging.error(e)
+				failed.append(object_name)
+
+		if failed:
+			raise RuntimeError(f"Failed to upload to S3: {', '.join(failed)}")
+
+		return uploaded
 
 
 	def list_files(self, pattern, folder=''):
@@ -1,14 +1,33 @@
+import logging
+import paramiko
 import pysftp
-import shutil
 import os
 import re
+import shutil
+import threading
+import time
+import zipfile
+import zlib
+
+from concurrent.futures import ThreadPoolExecutor
 
 class Sftp:
-	"""SFTP client for getting files from OCA"""
+	"""
+	SFTP client for getting files from OCA. Several files can be downloaded
+	at once, each over its own SFTP session on the same SSH connection.
+	"""
 
-	def __init__(self, host, user, pswd, dir):
-		self.sftp = pysftp.Connection(host=host, username=user, password=pswd)
+	def __init__(self, host, user, pswd, dir, max_files=4, buffer_size=1024 * 1024, max_attempts=5, part_dir=None):
+		self.connect_args = {'host': host, 'username': user, 'password': pswd}
+		self.sftp = pysftp.Connection(**self.connect_args)
 		self.dir = dir
+		self.max_files = max_files
+		self.buffer_size = buffer_size
+		self.max_attempts = max_attempts
+		self.part_dir = part_dir
+		if part_dir:
+			os.makedirs(part_dir, exist_ok=True)
+		self.lock = threading.Lock()
 
 
 	def list_files(self, pattern):
@@ -20,20 +39,147 @@ class Sftp:
 		return files
 
 
+	def file_version(self, remote_file):
+		"""
+		The size and modification time of a remote file, which change 
+		whenever the file is replaced (eg. to know if a cached copy is current)
+		"""
+		with self.lock:
+			stat = self.sftp.stat(os.path.join(self.dir, remote_file))
+		return f"{stat.st_size}-{stat.st_mtime}"
+
+
+	def open_session(self):
+		"""
+		Open a new SFTP session over the shared SSH connection, connecting
+		again first if the connection was lost
+		"""
+		with self.lock:
+			transport = self.sftp.sftp_client.get_channel().get_transport()
+			if not transport.is_active():
+				logging.warning("Reconnecting to the SFTP")
+				self.sftp = pysftp.Connection(**self.connect_args)
+				transport = self.sftp.sftp_client.get_channel().get_transport()
+
+		return paramiko.SFTPClient.from_transport(transport)
+
+
+	def transfer(self, remote_file, part_path):
+		"""
+		Copy a remote file to a local partial file, carrying on from the end
+		of the partial file if an earlier attempt left one. The reads are
+		prefetched, so many requests are in flight at once instead of
+		waiting for each block in turn.
+
+		:return: size of the remote file in bytes
+		"""
+		session = self.open_session()
+		try:
+			remote_path = os.path.join(self.dir, remote_file)
+			size = session.stat(remote_path).st_size
+			offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+			if offset > size:
+				offset = 0
+
+			with session.open(remote_path, 'rb') as remote, open(part_path, 'ab' if offset else 'wb') as local:
+				remote.seek(offset)
+				remote.prefetch(size)
+				while True:
+					data = remote.read(self.buffer_size)
+					if not data:
+						break
+					local.write(data)
+		finally:
+			session.close()
+
+		return size
+
+
+	def verify(self, remote_file, part_path, size):
+		"""
+		Check that a downloaded file is as big as the remote one and, for
+		zip files, that the CRC of everything in it matches its contents
+		"""
+		local_size = os.path.getsize(part_path)
+		if local_size != size:
+			raise RuntimeError(f"Downloaded {local_size} bytes of {remote_file} instead of {size}")
+
+		if remote_file.endswith('.zip'):
+			# Corrupt compressed data can fail to decompress before its CRC is checked
+			try:
+				with zipfile.ZipFile(part_path) as zip_file:
+					bad_file = zip_file.testzip()
+			except zlib.error as e:
+				raise zipfile.BadZipFile(f"Corrupt data in {remote_file}: {e}")
+			if bad_file is not None:
+				raise zipfile.BadZipFile(f"Bad CRC for {bad_file} in {remote_file}")
+
+
+	def download_file(self, remote_file, local_dir):
+		"""
+		Download a single file from SFTP to a local directory. The file is
+		downloaded to a ".part" file first, which is only moved into place
+		once its size and checksums are verified. A transfer that fails is
+		retried with backoff, resuming from where it stopped, and a file that
+		fails verification is downloaded again from the start.
+
+		The ".part" files are kept in part_dir if it's set, so a download
+		that still fails after every attempt (or whose run is killed) is
+		resumed by the next run. Otherwise they're kept next to the file,
+		and resuming only covers the retries of this call.
+
+		:param remote_file: name of the file in the SFTP directory
+		:param local_dir: str path to local directory to save the file
+		:return: path to the local file
+		"""
+		local_path = os.path.join(local_dir, remote_file)
+		part_path = os.path.join(self.part_dir or local_dir, remote_file + '.part')
+		start = time.time()
+
+		for attempt in range(1, self.max_attempts + 1):
+			try:
+				size = self.transfer(remote_file, part_path)
+				try:
+					self.verify(remote_file, part_path, size)
+				except Exception:
+					os.remove(part_path)
+					raise
+				# part_dir can be on another device than local_dir
+				shutil.move(part_path, local_path)
+				break
+			except (OSError, EOFError, paramiko.SSHException, RuntimeError, zipfile.BadZipFile) as e:
+				if attempt == self.max_attempts:
+					raise
+				logging.warning(f"Retrying download of {remote_file} after error: {e}")
+				time.sleep(2 ** attempt)
+
+		seconds = max(time.time() - start, 0.001)
+		print(f"  {remote_file}: {size / 1e6:.1f} MB in {seconds:.1f}s ({size / 1e6 / seconds:.1f} MB/s)")
+		return local_path
+
+
 	def download_files(self, remote_files, local_dir):
-	    """
-	    Download file(s) from SFTP to local directory
-
-	    :param remote_file_paths: list of file paths on SFTP server
-	    :param local_dir: str path to local directory to save files
-	    """
-
-	    remote_files = [remote_files] if isinstance(remote_files, str) else remote_files
-
-	    # https://stackoverflow.com/a/14210233/7051239
-	    for f in remote_files:
-	    	sftp_file = self.sftp.open(os.path.join(self.dir, f))
-	    	local_file = open(os.path.join(local_dir, f), 'wb')
-	    	shutil.copyfileobj(sftp_file, local_file)
-	    	local_file.close()
-	    	sftp_file.close()
+		"""
+		Download file(s) from SFTP to local directory, max_files at once.
+		Every download is attempted, then an error listing all the files
+		that failed is raised.
+
+		:param remote_files: file name or list of file names on SFTP server
+		:param local_dir: str path to local directory to save files
+		"""
+
+		remote_files = [remote_files] if isinstance(remote_files, str) else remote_files
+
+		with ThreadPoolExecutor(self.max_files) as pool:
+			futures = [(f, pool.submit(self.download_file, f, local_dir)) for f in remote_files]
+
+		failed = []
+		for f, future in futures:
+			try:
+				future.result()
+			except Exception as e:
+				logging.error(e)
+				failed.append(f)
+
+		if failed:
+			raise RuntimeError(f"Failed to download from SFTP: {', '.join(failed)}")
@@ -0,0 +1,177 @@
+import functools
+import itertools
+import re
+
+
+# Start and end tags for a case. The start tag needs to be followed by
+# whitespace or ">" so that it doesn't also match <IndexNumberId>
+INDEX_START_PAT = re.compile(rb'<(?:[\w.-]+:)?Index[\s>]')
+INDEX_END_PAT = re.compile(rb'</(?:[\w.-]+:)?Index\s*>')
+
+# The id of a case, which is always its first <IndexNumberId>
+INDEX_NUMBER_ID_PAT = re.compile(rb'<(?:[\w.-]+:)?IndexNumberId>([^<]*)<')
+
+# The name of the last opening tag in the header is the root element
+ROOT_TAG_PAT = re.compile(rb'<([\w.:-]+)[^>]*>')
+
+
+class CaseSplitter:
+    """
+    Splits an xml extract into the raw bytes of each <Index> case without
+    parsing any xml. Every case (or chunk of cases) can be wrapped with
+    the original xml declaration and root element to make a small
+    well-formed document that can be parsed on its own.
+
+    This assumes that the "</Index>" end tag never appears inside
+    comments or CDATA, which is the case for the OCA extracts.
+    """
+
+    def __init__(self, xml_file, block_size=4 * 1024 * 1024):
+        self.xml_file = xml_file
+        self.block_size = block_size
+        self.header = None
+        self.footer = None
+        self.data = b''
+        self.position = 0
+        self.eof = False
+
+
+    def read_block(self):
+        block = self.xml_file.read(self.block_size)
+        if block:
+            self.data += block
+        else:
+            self.eof = True
+
+
+    def read_header(self):
+        """
+        Read up to the first case, saving everything before it (xml
+        declaration and root element) to wrap chunks of cases with
+        """
+        while True:
+            match = INDEX_START_PAT.search(self.data)
+            if match or self.eof:
+                break
+            self.read_block()
+
+        start = match.start() if match else len(self.data)
+        self.header = self.data[:start]
+        self.data = self.data[start:]
+
+        root_tags = [m.group(1) for m in ROOT_TAG_PAT.finditer(self.header)]
+        self.footer = b'</' + root_tags[-1] + b'>' if root_tags else b''
+
+
+    def __iter__(self):
+        """ yield the raw bytes of each case, in file order """
+        if self.header is None:
+            self.read_header()
+
+        # Keep track of where the next case starts instead of slicing the 
+        # buffer after every case, which would copy the whole block each time. 
+        # It's kept on the splitter so that iterating again carries on from 
+        # the last case yielded.
+        while True:
+            match = INDEX_END_PAT.search(self.data, self.position)
+
+            if match is None:
+                if self.eof:
+                    return
+                self.data = self.data[self.position:]
+                self.position = 0
+                self.read_block()
+                continue
+
+            start = INDEX_START_PAT.search(self.data, self.position)
+            self.position = match.end()
+            yield self.data[start.start():match.end()]
+
+
+    def skip(self, cases):
+        """
+        Skip over the next cases without parsing them (eg. the ones already 
+        loaded before a run was interrupted). Returns the number of cases 
+        skipped, which is less than asked for if the file ends first.
+        """
+        return sum(1 for case in itertools.islice(self, cases))
+
+
+    def remainder(self):
+        """
+        A file-like object for a well-formed xml document with every case 
+        that hasn't been yielded yet, made of the header and the rest of 
+        the file, to be parsed as usual
+        """
+        if self.header is None:
+            self.read_header()
+
+        rest = iter(functools.partial(self.xml_file.read, self.block_size), b'')
+        return IterReader(itertools.chain([self.header, self.data[self.position:]], rest))
+
+
+    def filtered(self, keep):
+        """
+        A file-like object for a well-formed xml document with only some of 
+        the cases that haven't been yielded yet. keep is called with the 
+        IndexNumberId of every case, in file order, and returns whether to 
+        include it.
+        """
+        def blocks():
+            if self.header is None:
+                self.read_header()
+            yield self.header
+            for case in self:
+                if keep(case_index_number_id(case)):
+                    yield case + b'\n'
+            yield self.footer
+
+        return IterReader(blocks())
+
+
+    def chunks(self, cases_per_chunk):
+        """ yield the raw bytes of groups of consecutive cases, in file order """
+        chunk = []
+        for case in self:
+            chunk.append(case)
+            if len(chunk) == cases_per_chunk:
+                yield b'\n'.join(chunk)
+                chunk = []
+
+        if chunk:
+            yield b'\n'.join(chunk)
+
+
+    def wrap(self, cases):
+        """ make a well-formed xml document from the raw bytes of some cases """
+        return self.header + cases + b'\n' + self.footer
+
+
+def case_index_number_id(case):
+    """ get the IndexNumberId of a case from its raw bytes, or None if it has none """
+    match = INDEX_NUMBER_ID_PAT.search(case)
+    return match.group(1).decode('utf-8') if match else None
+
+
+class IterReader:
+    """ A read-only file-like object for the bytes yielded by an iterable """
+
+    def __init__(self, blocks):
+        self.blocks = iter(blocks)
+        self.data = b''
+        self.position = 0
+
+
+    def read(self, size=-1):
+        while self.position >= len(self.data):
+            self.data = next(self.blocks, None)
+            self.position = 0
+            if self.data is None:
+                self.data = b''
+                return b''
+
+        if size is None or size < 0:
+            size = len(self.data)
+        block = self.data[self.position:self.position + size]
+        self.position += len(block)
+        return block
@@ -0,0 +1,15 @@
+-- Adds back the foreign keys dropped by "drop_constraints.sql", with the 
+-- same names postgres gives them in "create_tables.sql". Adding a foreign 
+-- key checks every existing row, so this fails if the bulk load left any 
+-- rows without a case in "oca_index".
+
+ALTER TABLE oca_causes ADD CONSTRAINT oca_causes_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_addresses ADD CONSTRAINT oca_addresses_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_parties ADD CONSTRAINT oca_parties_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_events ADD CONSTRAINT oca_events_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_appearances ADD CONSTRAINT oca_appearances_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_appearance_outcomes ADD CONSTRAINT oca_appearance_outcomes_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_motions ADD CONSTRAINT oca_motions_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_decisions ADD CONSTRAINT oca_decisions_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_judgments ADD CONSTRAINT oca_judgments_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
+ALTER TABLE oca_warrants ADD CONSTRAINT oca_warrants_indexnumberid_fkey FOREIGN KEY (indexnumberid) REFERENCES oca_index ON DELETE CASCADE;
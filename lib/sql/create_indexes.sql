@@ -0,0 +1,19 @@
+-- Every table references "oca_index" with ON DELETE CASCADE, so each needs 
+-- an index on "indexnumberid" for deleting a case (or replacing a re-sent 
+-- one) to look up its rows instead of scanning the whole table. These are 
+-- the names postgres gives unnamed indexes, so they match the indexes in 
+-- older dumps and are only created if they're missing.
+-- 
+-- They're dropped by "drop_indexes.sql" while loading the Initial files 
+-- when rebuilding, and created again afterwards.
+
+CREATE INDEX IF NOT EXISTS oca_causes_indexnumberid_idx ON oca_causes (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_addresses_indexnumberid_idx ON oca_addresses (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_parties_indexnumberid_idx ON oca_parties (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_events_indexnumberid_idx ON oca_events (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_appearances_indexnumberid_idx ON oca_appearances (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_appearance_outcomes_indexnumberid_idx ON oca_appearance_outcomes (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_motions_indexnumberid_idx ON oca_motions (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_decisions_indexnumberid_idx ON oca_decisions (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_judgments_indexnumberid_idx ON oca_judgments (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_warrants_indexnumberid_idx ON oca_warrants (indexnumberid);
@@ -0,0 +1,26 @@
+-- These tables keep track of the state of the database itself, so that a 
+-- database that persists between runs doesn't need to be restored from 
+-- the SQL dump every time. "oca_ingest_files" is the ledger of data files 
+-- that have been applied to the main tables, and "oca_ingest_state" holds 
+-- other values like the fingerprint (S3 ETag) of the dump that the 
+-- database currently matches.
+
+CREATE TABLE IF NOT EXISTS oca_ingest_files (
+	filename text PRIMARY KEY,
+	appliedat timestamp DEFAULT now()
+);
+
+CREATE TABLE IF NOT EXISTS oca_ingest_state (
+	key text PRIMARY KEY,
+	value text
+);
+
+-- While a data file is being parsed into the staging tables, the number of 
+-- its cases loaded so far is saved here in the same transaction as their 
+-- rows, so that if the run is interrupted the next one can carry on from 
+-- there. The checkpoint is removed once the file is in the main tables.
+CREATE TABLE IF NOT EXISTS oca_parse_checkpoints (
+	filename text PRIMARY KEY,
+	cases bigint NOT NULL,
+	updatedat timestamp DEFAULT now()
+);
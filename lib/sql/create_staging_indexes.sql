@@ -0,0 +1,23 @@
+-- The staging tables are created without indexes so they load as fast as 
+-- possible, then the ones used to find the cases to remove from the main 
+-- tables are indexed once they're full. All the staging tables are 
+-- analyzed so that merging them into the main tables is planned from their 
+-- real sizes, rather than scanning the main tables. The indexes are named 
+-- (with the names postgres would give them) so that staging a file again 
+-- after resuming from a checkpoint doesn't add a second copy of each.
+
+CREATE INDEX IF NOT EXISTS oca_index_staging_indexnumberid_idx ON oca_index_staging (indexnumberid);
+CREATE INDEX IF NOT EXISTS oca_deletes_staging_indexnumberid_idx ON oca_deletes_staging (indexnumberid);
+
+ANALYZE oca_index_staging;
+ANALYZE oca_causes_staging;
+ANALYZE oca_addresses_staging;
+ANALYZE oca_parties_staging;
+ANALYZE oca_events_staging;
+ANALYZE oca_appearances_staging;
+ANALYZE oca_appearance_outcomes_staging;
+ANALYZE oca_motions_staging;
+ANALYZE oca_decisions_staging;
+ANALYZE oca_judgments_staging;
+ANALYZE oca_warrants_staging;
+ANALYZE oca_deletes_staging;
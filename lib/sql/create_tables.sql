@@ -135,15 +135,3 @@ CREATE TABLE IF NOT EXISTS oca_warrants (
   returnedreason text,
   executiondate date
 );
-
-
-CREATE INDEX ON oca_causes (indexnumberid);
-CREATE INDEX ON oca_addresses (indexnumberid);
-CREATE INDEX ON oca_parties (indexnumberid);
-CREATE INDEX ON oca_events (indexnumberid);
-CREATE INDEX ON oca_appearances (indexnumberid);
-CREATE INDEX ON oca_appearance_outcomes (indexnumberid);
-CREATE INDEX ON oca_motions (indexnumberid);
-CREATE INDEX ON oca_decisions (indexnumberid);
-CREATE INDEX ON oca_judgments (indexnumberid);
-CREATE INDEX ON oca_warrants (indexnumberid);
@@ -0,0 +1,14 @@
+-- The foreign keys from every table to "oca_index" (declared in 
+-- "create_tables.sql"). They're dropped while the Initial files are bulk 
+-- loaded in fast-load mode, then added back by "create_constraints.sql".
+
+ALTER TABLE oca_causes DROP CONSTRAINT IF EXISTS oca_causes_indexnumberid_fkey;
+ALTER TABLE oca_addresses DROP CONSTRAINT IF EXISTS oca_addresses_indexnumberid_fkey;
+ALTER TABLE oca_parties DROP CONSTRAINT IF EXISTS oca_parties_indexnumberid_fkey;
+ALTER TABLE oca_events DROP CONSTRAINT IF EXISTS oca_events_indexnumberid_fkey;
+ALTER TABLE oca_appearances DROP CONSTRAINT IF EXISTS oca_appearances_indexnumberid_fkey;
+ALTER TABLE oca_appearance_outcomes DROP CONSTRAINT IF EXISTS oca_appearance_outcomes_indexnumberid_fkey;
+ALTER TABLE oca_motions DROP CONSTRAINT IF EXISTS oca_motions_indexnumberid_fkey;
+ALTER TABLE oca_decisions DROP CONSTRAINT IF EXISTS oca_decisions_indexnumberid_fkey;
+ALTER TABLE oca_judgments DROP CONSTRAINT IF EXISTS oca_judgments_indexnumberid_fkey;
+ALTER TABLE oca_warrants DROP CONSTRAINT IF EXISTS oca_warrants_indexnumberid_fkey;
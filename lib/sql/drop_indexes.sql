@@ -0,0 +1,14 @@
+-- The secondary indexes from "create_indexes.sql". Loading lots of rows is 
+-- much faster without them, and building them once afterwards is faster 
+-- than updating them for every row.
+
+DROP INDEX IF EXISTS oca_causes_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_addresses_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_parties_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_events_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_appearances_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_appearance_outcomes_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_motions_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_decisions_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_judgments_indexnumberid_idx;
+DROP INDEX IF EXISTS oca_warrants_indexnumberid_idx;
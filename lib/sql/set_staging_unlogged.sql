@@ -0,0 +1,16 @@
+-- In fast-load mode the staging tables don't write to the WAL. They only 
+-- hold one file on its way to the main tables, so if the database crashes 
+-- they can just be parsed again.
+
+ALTER TABLE oca_index_staging SET UNLOGGED;
+ALTER TABLE oca_causes_staging SET UNLOGGED;
+ALTER TABLE oca_addresses_staging SET UNLOGGED;
+ALTER TABLE oca_parties_staging SET UNLOGGED;
+ALTER TABLE oca_events_staging SET UNLOGGED;
+ALTER TABLE oca_appearances_staging SET UNLOGGED;
+ALTER TABLE oca_appearance_outcomes_staging SET UNLOGGED;
+ALTER TABLE oca_motions_staging SET UNLOGGED;
+ALTER TABLE oca_decisions_staging SET UNLOGGED;
+ALTER TABLE oca_judgments_staging SET UNLOGGED;
+ALTER TABLE oca_warrants_staging SET UNLOGGED;
+ALTER TABLE oca_deletes_staging SET UNLOGGED;
@@ -0,0 +1,288 @@
+import datetime
+import random
+import zipfile
+from xml.sax.saxutils import escape
+
+
+# Generates fake extracts in the same format as the OCA files, for testing
+# and benchmarking without access to the real data. The values are made up,
+# but the structure of the cases and the number of rows in each table are
+# roughly like the real extracts.
+
+NAMESPACE = 'http://www.example.org/LandlordTenantExtractSchema'
+EXTRACT_FILENAME = 'LandlordTenantExtract.xml'
+
+COURTS = [
+    'Bronx County Civil Court', 'Kings County Civil Court', 'New York County Civil Court',
+    'Queens County Civil Court', 'Richmond County Civil Court', 'Redhook Community Justice Center',
+    'Harlem Community Justice Center',
+]
+CITIES = ['Bronx', 'Brooklyn', 'New York', 'Jamaica', 'Flushing', 'Staten Island', 'Astoria']
+CLASSIFICATIONS = ['Non-Payment', 'Holdover', 'HP', 'Illegal Lockout', 'Article 7A', 'Breach of Warrant of Habitability']
+STATUSES = ['Active', 'Disposed', 'Active - Restored', 'Post Disposition', 'Disposed - Appeal Pending']
+DISPOSED_REASONS = ['Judgment', 'Settled', 'Discontinued', 'Dismissed', 'Transfer to Another Court']
+FIRST_PAPERS = ['Petition by Attorney', 'Petition by Self Represented Landlord', 'Commenced by OSC', 'Predicate OSC']
+SPECIALTY_DESIGNATIONS = ['NYCHA', 'COOP/CONDO', 'Military', 'UA ZIP', 'Rent Stabilized']
+CAUSES = ['Non-Payment', 'Holdover', 'Use and Occupancy', 'Breach of Lease', 'Violations', 'Other']
+ROLES = ['Petitioner', 'Respondent', 'Interested Party']
+PARTY_TYPES = ['Person', 'Business', 'Agency']
+REPRESENTATION_TYPES = ['Counsel', 'SRL', 'No Appearance']
+EVENT_NAMES = [
+    'Answer Filed', 'Affidavit of Service Filed', 'Counterclaim Filed', 'Subpoena Issued',
+    "Marshal's Request for Warrant", 'Stipulation of Settlement', 'Notice of Petition Issued',
+]
+FEE_TYPES = ['Collected', 'Exempt', 'Waived by Judge']
+ANSWER_TYPES = ['Oral', 'Written']
+APPEARANCE_PURPOSES = ['Hearing', 'Conference', 'Motion', 'Trial']
+APPEARANCE_REASONS = ['New Appearance', 'Adjourned', 'Rescheduled', 'Continued', 'System Scheduled']
+APPEARANCE_OUTCOMES = ['Adjourned', 'Reserved Decision', 'Dismissed', 'Settled', 'Marked Off', 'Decided']
+OUTCOME_BASES = ['Conference', 'Hearing', 'Stipulation', 'Default']
+MOTION_TYPES = ['Order to Show Cause', 'General', 'Ex-Parte']
+PRIMARY_RELIEFS = ['Restore to Possession', 'Restore to Calendar', 'Vacate Judgment', 'Stay of Execution']
+MOTION_DECISIONS = ['Granted', 'Denied', 'Withdrawn', 'Denied - Index Disposed']
+DECISION_RESULTS = ['Reserved Decision', 'Courtroom Appearance', 'Arbitration', 'Conversion Event']
+JUDGMENT_TYPES = ['Failure to Answer', 'Failure to Appear', 'Hearing', 'Stipulation', 'Inquest']
+JUDGMENT_STATUSES = ['Entered', 'Vacated', 'Partially Satisfied', 'Satisfied']
+WARRANT_REASONS = ['Original Issuance', 'Re-issued', 'Duplicate Original', 'Amended']
+ISSUANCE_TYPES = ['No Stay/Issuance Forthwith', 'Stayed - Number of Days', 'Stayed - Until Date']
+EXECUTION_TYPES = ['No Stay', 'Stayed - Per Stipulation/Order']
+RETURNED_REASONS = ['Executed with Eviction', 'Withdrawn', 'Expired']
+
+# Some free text is messy in the real data, and needs escaping in the xml
+# and in COPY
+MESSY_TEXT = ['Tenant said "no access"', 'Back rent\\fees', 'Adj. to 3/1 - "final"', 'Stip: pay $500\tmonthly']
+
+
+def element(tag, value):
+    return '' if value is None else f"<{tag}>{escape(str(value))}</{tag}>"
+
+
+def elements(container, item, children):
+    return f"<{container}>" + ''.join(f"<{item}>{c}</{item}>" for c in children) + f"</{container}>"
+
+
+class CaseGenerator:
+    """
+    Makes the xml for fake cases. The same seed always makes the same
+    cases, so benchmarks can be repeated on exactly the same data.
+    """
+
+    def __init__(self, seed=0, year=2019):
+        self.rng = random.Random(seed)
+        self.year = year
+
+
+    def count(self, mean, maximum):
+        """ a small random count, usually near the mean but sometimes much bigger """
+        return min(int(self.rng.expovariate(1 / mean) + 0.5), maximum) if mean else 0
+
+
+    def maybe(self, probability, value):
+        return value if self.rng.random() < probability else None
+
+
+    def date(self, start, max_days=365):
+        return start + datetime.timedelta(days=self.rng.randrange(max_days))
+
+
+    def amount(self):
+        return f"{self.rng.lognormvariate(8, 1):.2f}"
+
+
+    def roles(self, container, item, n=1):
+        return elements(container, item, [element('Role', self.rng.choice(ROLES[:2])) for _ in range(n)])
+
+
+    def warrant(self, letter, judgment_date):
+        rng = self.rng
+        ordered = self.date(judgment_date, 60)
+        city = rng.choice(CITIES)
+        properties = elements('PropertiesOnWarrant', 'PropertyOnWarrant', [
+            element('City', city) + element('State', 'NY') + element('PostalCode', rng.randrange(10001, 11698))
+        ])
+        return ''.join([
+            element('Sequence', letter),
+            element('CreatedReason', rng.choice(WARRANT_REASONS)),
+            element('OrderedDate', ordered),
+            element('IssuanceType', rng.choice(ISSUANCE_TYPES)),
+            self.maybe(0.3, element('IssuanceStayedDate', self.date(ordered, 30))) or '',
+            self.maybe(0.3, element('IssuanceStayedDays', rng.randrange(5, 30))) or '',
+            element('IssuedDate', self.date(ordered, 30)),
+            element('ExecutionType', rng.choice(EXECUTION_TYPES)),
+            element('MarshalRequestDate', self.date(ordered, 30)),
+            element('EnforcementAgency', 'Marshal ' + rng.choice('ABCDEFGH')),
+            element('EnforcementOfficerDocketNumber', rng.randrange(100000, 999999)),
+            properties,
+            self.maybe(0.4, element('ReturnedDate', self.date(ordered, 120))) or '',
+            self.maybe(0.4, element('ReturnedReason', rng.choice(RETURNED_REASONS))) or '',
+            self.maybe(0.2, element('ExecutionDate', self.date(ordered, 90))) or '',
+        ])
+
+
+    def judgment(self, sequence, filed):
+        rng = self.rng
+        judgment_date = self.date(filed, 200)
+        warrants = [ self.warrant(chr(ord('A') + i), judgment_date) for i in range(self.count(0.6, 3)) ]
+        return ''.join([
+            element('Sequence', sequence),
+            self.maybe(0.1, element('AmendedFromJudgmentSequence', sequence - 1 or 1)) or '',
+            element('JudgmentType', rng.choice(JUDGMENT_TYPES)),
+            element('FiledDate', judgment_date),
+            element('EnteredDateTime', f"{self.date(judgment_date, 10)}T{rng.randrange(9, 17):02}:00:00"),
+            element('WithPossession', rng.choice(['true', 'false'])),
+            element('LatestJudgmentStatus', rng.choice(JUDGMENT_STATUSES)),
+            element('LatestJudgmentStatusDate', self.date(judgment_date, 60)),
+            element('TotalJudgmentAmount', self.amount()),
+            self.roles('Creditors', 'Creditor'),
+            self.roles('Debtors', 'Debtor', 1 + self.count(0.3, 3)),
+            elements('Warrants', 'Warrant', warrants) if warrants else '',
+        ])
+
+
+    def case(self, index_number_id):
+        """ the xml for a whole case (an <Index> element) """
+        rng = self.rng
+        filed = self.date(datetime.date(self.year, 1, 1))
+        disposed = rng.random() < 0.7
+
+        parts = [
+            element('IndexNumberId', index_number_id),
+            element('Court', rng.choice(COURTS)),
+            element('FiledDate', filed),
+            element('PropertyType', 'Residential' if rng.random() < 0.95 else 'Commercial'),
+            element('Classification', rng.choice(CLASSIFICATIONS)),
+        ]
+
+        if rng.random() < 0.2:
+            parts.append(elements('SpecialtyDesignations', 'SpecialtyDesignationType', [
+                escape(d) for d in rng.sample(SPECIALTY_DESIGNATIONS, 1 + self.count(0.3, 2))
+            ]))
+
+        parts += [
+            element('Status', rng.choice(STATUSES[1:] if disposed else STATUSES[:1])),
+            element('DisposedDate', self.date(filed, 500)) if disposed else '',
+            element('DisposedReasonNoPersonallyIdentifyingInfo', rng.choice(DISPOSED_REASONS)) if disposed else '',
+            element('FirstPaper', rng.choice(FIRST_PAPERS)),
+            element('PrimaryClaimTotal', self.amount()),
+            self.maybe(0.02, element('DateOfJuryDemand', self.date(filed, 100))) or '',
+        ]
+
+        parts.append(elements('PrimaryClaimCauseOfActions', 'PrimaryClaimCauseOfAction', [
+            element('CauseOfActionType', rng.choice(CAUSES))
+            + (self.maybe(0.3, element('InterestFromDate', self.date(filed, 100))) or '')
+            + element('Amount', self.amount())
+            for _ in range(1 + self.count(0.2, 4))
+        ]))
+
+        parts.append(elements('PropertyAddresses', 'PropertyAddress', [
+            element('City', rng.choice(CITIES)) + element('State', 'NY') + element('PostalCode', rng.randrange(10001, 11698))
+        ]))
+
+        parties = [
+            element('Role', 'Petitioner') + element('PartyType', rng.choice(PARTY_TYPES))
+            + element('RepresentationType', 'Counsel')
+        ] + [
+            element('Role', rng.choice(ROLES[1:])) + element('PartyType', 'Person')
+            + element('RepresentationType', rng.choice(REPRESENTATION_TYPES))
+            + element('Undertenant', rng.choice(['true', 'false']))
+            for _ in range(1 + self.count(1, 10))
+        ]
+        parts.append(elements('Parties', 'Party', parties))
+
+        events = [
+            element('EventName', rng.choice(EVENT_NAMES)) + element('FiledDate', self.date(filed, 400))
+            + (self.maybe(0.5, element('FeeType', rng.choice(FEE_TYPES))) or '')
+            + self.roles('FilingParties', 'FilingParty')
+            + (self.maybe(0.2, element('AnswerType', rng.choice(ANSWER_TYPES))) or '')
+            for _ in range(self.count(4, 40))
+        ]
+        if events:
+            parts.append(elements('Events', 'Event', events))
+
+        appearances = []
+        for _ in range(self.count(3, 30)):
+            outcomes = [
+                element('AppearanceOutcomeType', rng.choice(APPEARANCE_OUTCOMES))
+                + (self.maybe(0.6, element('OutcomeBasedOnType', rng.choice(OUTCOME_BASES))) or '')
+                for _ in range(self.count(1.2, 5))
+            ]
+            appearances.append(
+                element('AppearanceDateTime', f"{self.date(filed, 500)}T{rng.randrange(9, 17):02}:30:00")
+                + element('AppearancePurpose', rng.choice(APPEARANCE_PURPOSES))
+                + element('AppearanceReason', rng.choice(APPEARANCE_REASONS))
+                + element('AppearancePart', 'Part ' + rng.choice('ABCDEFGHJKLMNRSTX'))
+                + (self.maybe(0.1, element('MotionSequence', 1)) or '')
+                + (elements('AppearanceOutcomes', 'AppearanceOutcome', outcomes) if outcomes else '')
+            )
+        if appearances:
+            parts.append(elements('Appearances', 'Appearance', appearances))
+
+        motions = [
+            element('Sequence', i + 1) + element('MotionType', rng.choice(MOTION_TYPES))
+            + element('PrimaryRelief', rng.choice(PRIMARY_RELIEFS)) + element('FiledDate', self.date(filed, 400))
+            + self.roles('FilingParties', 'FilingParty')
+            + element('MotionDecision', rng.choice(MOTION_DECISIONS))
+            + element('MotionDecisionDate', self.date(filed, 450))
+            for i in range(self.count(0.5, 10))
+        ]
+        if motions:
+            parts.append(elements('Motions', 'Motion', motions))
+
+        decisions = [
+            element('Sequence', i + 1) + element('ResultOf', rng.choice(DECISION_RESULTS))
+            + element('HighlightNoPersonallyIdentifyingInfo', rng.choice(MESSY_TEXT))
+            for i in range(self.count(1, 10))
+        ]
+        if decisions:
+            parts.append(elements('Decisions', 'Decision', decisions))
+
+        judgments = [ self.judgment(i + 1, filed) for i in range(self.count(0.5, 4)) ]
+        if judgments:
+            parts.append(elements('Judgments', 'Judgment', judgments))
+
+        return '<Index>' + ''.join(parts) + '</Index>'
+
+
+    def deleted_case(self, index_number_id):
+        """ the xml for a case flagged for deletion """
+        return '<Index>' + element('IndexNumberId', index_number_id) + '<Delete/></Index>'
+
+
+def write_extract(f, cases, seed=0, year=2019, first_id=0, delete_fraction=0):
+    """
+    Writes a fake extract with the given number of cases to a binary file.
+    Case ids are numbered from first_id, so an extract with an overlapping
+    range of ids acts like an Incr file that re-sends cases. A fraction of
+    the cases can be flagged for deletion instead.
+
+    :param f: a binary file-like object
+    :param cases: number of cases
+    :param seed: seed for the random values
+    :param year: filing year of the cases
+    :param first_id: number of the first case id
+    :param delete_fraction: fraction of the cases flagged for deletion
+    """
+    generator = CaseGenerator(seed, year)
+
+    f.write(f'<?xml version="1.0" encoding="UTF-8"?>\n<LandlordTenantExtract xmlns="{NAMESPACE}">\n'.encode())
+    for i in range(first_id, first_id + cases):
+        index_number_id = f"LT-{i:08}-{year}"
+        if generator.rng.random() < delete_fraction:
+            case = generator.deleted_case(index_number_id)
+        else:
+            case = generator.case(index_number_id)
+        f.write(case.encode() + b'\n')
+    f.write(b'</LandlordTenantExtract>\n')
+
+
+def write_extract_zip(zip_path, cases, **kwargs):
+    """
+    Writes a fake extract to a zip file like the ones on the SFTP. Takes
+    the same keyword arguments as write_extract.
+
+    :param zip_path: path for the zip file
+    :param cases: number of cases
+    """
+    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        with zf.open(EXTRACT_FILENAME, 'w') as f:
+            write_extract(f, cases, **kwargs)
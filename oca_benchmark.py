@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+import argparse
+import dotenv
+import json
+import os
+import tempfile
+import time
+import zipfile
+
+from lib.database import Database
+from lib.etl import OCA_TABLES, insert_staging_to_main
+from lib.memory import peak_rss
+from lib.parsers import DATA_FILENAME, parse_file
+from lib.synthetic import write_extract_zip
+
+dotenv.load_dotenv()
+
+
+# Benchmarks parsing, merging and exporting on synthetic extracts (see
+# lib/synthetic.py), so that changes can be measured without the real
+# files. The same seed always makes the same data, so the numbers from
+# different runs can be compared.
+#
+# WARNING: this drops and recreates all the tables in the database it's
+# given, so never point it at a database you want to keep.
+
+
+def table_counts(db, suffix=''):
+	return {t: db.query(f"SELECT count(*) FROM {t}{suffix}")[0][0] for t in OCA_TABLES}
+
+
+def benchmark_file(db, zip_file, cases, parse_args):
+	""" stage a synthetic file and merge it into the main tables, timing each step """
+	db.execute_sql_file('create_tables_staging.sql')
+
+	start = time.perf_counter()
+	with zipfile.ZipFile(zip_file, 'r').open(DATA_FILENAME) as xml_file:
+		parse_file(xml_file, db, **parse_args)
+	parse_seconds = time.perf_counter() - start
+	print()
+
+	rows = table_counts(db, '_staging')
+	db.execute_sql_file('create_staging_indexes.sql')
+
+	start = time.perf_counter()
+	insert_staging_to_main(db)
+	merge_seconds = time.perf_counter() - start
+
+	return {
+		'cases': cases,
+		'parse_seconds': parse_seconds,
+		'cases_per_second': cases / parse_seconds,
+		'rows': rows,
+		'rows_per_second': {t: n / parse_seconds for t, n in rows.items()},
+		'merge_seconds': merge_seconds,
+	}
+
+
+def benchmark_export(db, out_dir):
+	""" export every table to csv, timing each one """
+	results = {}
+	for table in OCA_TABLES:
+		start = time.perf_counter()
+		db.export_csv(table, os.path.join(out_dir, f"{table}.csv"))
+		seconds = time.perf_counter() - start
+		rows = db.query(f"SELECT count(*) FROM {table}")[0][0]
+		results[table] = {'seconds': seconds, 'rows_per_second': rows / seconds if seconds else 0}
+	return results
+
+
+def print_report(report):
+	for name in ('initial', 'incr'):
+		result = report.get(name)
+		if not result:
+			continue
+		print(f"\n{name}: {result['cases']} cases parsed in {result['parse_seconds']:.1f}s "
+			f"({result['cases_per_second']:.0f} cases/s), merged in {result['merge_seconds']:.1f}s")
+		for table, rows in result['rows'].items():
+			print(f"  {table:<26} {rows:>10} rows {result['rows_per_second'][table]:>10.0f} rows/s")
+
+	print("\nexport:")
+	for table, result in report['export'].items():
+		print(f"  {table:<26} {result['seconds']:>8.1f}s {result['rows_per_second']:>10.0f} rows/s")
+
+	print(f"\npeak memory: {report['peak_rss'] / 1e6:.0f} MB")
+
+
+def main():
+	parser = argparse.ArgumentParser(description=(
+		"Benchmark parsing, merging and exporting synthetic extracts. "
+		"This drops and recreates all the tables in the database."
+	))
+	parser.add_argument('--db-url', default=os.environ.get('OCA_BENCHMARK_DATABASE_URL'),
+		help="database to use (default: $OCA_BENCHMARK_DATABASE_URL)")
+	parser.add_argument('--cases', type=int, default=10000, help="number of cases in the Initial file")
+	parser.add_argument('--incr-cases', type=int, default=1000,
+		help="number of cases in the Incr file (half re-sent, some deleted), 0 to skip it")
+	parser.add_argument('--seed', type=int, default=0, help="seed for the synthetic data")
+	parser.add_argument('--workers', type=int, default=1, help="number of processes to parse with")
+	parser.add_argument('--cases-per-chunk', type=int, default=1000, help="cases sent to a worker at a time")
+	parser.add_argument('--output', help="also write the results to this json file")
+	args = parser.parse_args()
+
+	if not args.db_url:
+		parser.error("a database is required (--db-url or $OCA_BENCHMARK_DATABASE_URL)")
+
+	parse_args = {'workers': args.workers, 'cases_per_chunk': args.cases_per_chunk}
+
+	db = Database(args.db_url)
+	db.execute_sql_file('create_tables.sql')
+	db.execute_sql_file('create_indexes.sql')
+
+	# The database url can have a password in it, so it's left out of the report
+	report = {'args': {k: v for k, v in vars(args).items() if k != 'db_url'}}
+
+	with tempfile.TemporaryDirectory() as tmp_dir:
+		print(f"Generating {args.cases} cases...")
+		initial_zip = os.path.join(tmp_dir, 'LandlordTenant.Initial.FiledIn2019.2020-01-01.zip')
+		write_extract_zip(initial_zip, args.cases, seed=args.seed)
+
+		print("Parsing and merging the Initial file...")
+		report['initial'] = benchmark_file(db, initial_zip, args.cases, parse_args)
+
+		if args.incr_cases:
+			print(f"Generating {args.incr_cases} cases...")
+			incr_zip = os.path.join(tmp_dir, 'LandlordTenant.Incr.2020-01-02.zip')
+			write_extract_zip(incr_zip, args.incr_cases, seed=args.seed + 1,
+				first_id=args.cases - args.incr_cases // 2, delete_fraction=0.02)
+
+			print("Parsing and merging the Incr file...")
+			report['incr'] = benchmark_file(db, incr_zip, args.incr_cases, parse_args)
+
+		print("Exporting tables...")
+		report['export'] = benchmark_export(db, tmp_dir)
+
+	report['peak_rss'] = peak_rss()
+
+	print_report(report)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump(report, f, indent=2)
+
+if __name__== "__main__":
+	main()
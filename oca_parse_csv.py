@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+
+import argparse
+import os
+import time
+import zipfile
+
+from lib.parsers import DATA_FILENAME, CsvTables, parse_file
+
+
+# Parses a local data zip file straight into a CSV file for each table,
+# without a database or any network access. The files have a header row
+# and can be loaded later with "COPY <table> (<columns>) FROM ... WITH CSV
+# HEADER" (eg. with psql's \copy).
+
+
+def main():
+	parser = argparse.ArgumentParser(description=(
+		"Parse a local OCA data zip file into a CSV file for each table, without a database."
+	))
+	parser.add_argument('zip_file', help="path to a data zip file (eg. LandlordTenant.Incr.2020-01-02.zip)")
+	parser.add_argument('--output-dir', default='csv', help="directory to write the CSV files to (default: csv)")
+	parser.add_argument('--workers', type=int, default=1, help="number of processes to parse with")
+	parser.add_argument('--cases-per-chunk', type=int, default=1000, help="cases sent to a worker at a time")
+	parser.add_argument('--huge-tree', action='store_true', help="allow very deep trees and very large text nodes")
+	args = parser.parse_args()
+
+	parse_args = {
+		'workers': args.workers,
+		'cases_per_chunk': args.cases_per_chunk,
+		'huge_tree': args.huge_tree,
+	}
+
+	start = time.perf_counter()
+	zip_size = os.path.getsize(args.zip_file)
+	with CsvTables(args.output_dir) as tables, open(args.zip_file, 'rb') as raw_file:
+		with zipfile.ZipFile(raw_file, 'r').open(DATA_FILENAME) as xml_file:
+			rows = parse_file(xml_file, tables, progress=(zip_size, raw_file.tell), **parse_args)
+	seconds = time.perf_counter() - start
+
+	print(f"\nParsed in {seconds:.1f}s:")
+	for table_name, path in tables.paths.items():
+		print(f"  {path:<40} {rows.get(table_name, 0):>10} rows")
+
+if __name__== "__main__":
+	main()
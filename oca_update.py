@@ -4,28 +4,77 @@ import dotenv
 import os
 
 from lib.etl import oca_etl
+from lib.metrics import RunReport
 
 dotenv.load_dotenv()
 
 def main():
 
 	db_args = {
-		'db_url': os.environ.get('DATABASE_URL', '')
+		'db_url': os.environ.get('DATABASE_URL', ''),
+		'dump_jobs': int(os.environ.get('OCA_DUMP_JOBS', 4))
 	}
 
 	s3_args = {
 		'aws_id': os.environ.get('AWS_ACCESS_KEY_ID', ''),
-		'aws_key': os.environ.get('AWS_SECRET_ACCESS_KEY', '')
+		'aws_key': os.environ.get('AWS_SECRET_ACCESS_KEY', ''),
+		'part_size': int(os.environ.get('OCA_S3_PART_SIZE', 64 * 1024 * 1024)),
+		'max_concurrency': int(os.environ.get('OCA_S3_CONCURRENCY', 8)),
+		'max_attempts': int(os.environ.get('OCA_S3_MAX_ATTEMPTS', 5)),
+		'max_files': int(os.environ.get('OCA_S3_MAX_FILES', 4)),
+		'stream_concurrency': int(os.environ.get('OCA_S3_STREAM_CONCURRENCY', 2))
 	}
 
 	sftp_args = {
 		'host': os.environ.get('SFTP_HOST', ''),
 		'user': os.environ.get('SFTP_USER', ''),
 		'pswd': os.environ.get('SFTP_PSWD', ''),
-		'dir': os.environ.get('SFTP_DIR', '')
+		'dir': os.environ.get('SFTP_DIR', ''),
+		'max_files': int(os.environ.get('OCA_SFTP_MAX_FILES', 4)),
+		'buffer_size': int(os.environ.get('OCA_SFTP_BUFFER_SIZE', 1024 * 1024)),
+		'max_attempts': int(os.environ.get('OCA_SFTP_MAX_ATTEMPTS', 5)),
+		'part_dir': os.environ.get('OCA_SFTP_PART_DIR') or None
 	}
 
-	oca_etl(db_args, sftp_args, s3_args)
+	parse_args = {
+		'max_rows': int(os.environ.get('OCA_BUFFER_MAX_ROWS', 100000)),
+		'max_bytes': int(os.environ.get('OCA_BUFFER_MAX_BYTES', 64 * 1024 * 1024)),
+		'workers': int(os.environ.get('OCA_PARSE_WORKERS', 1)),
+		'cases_per_chunk': int(os.environ.get('OCA_PARSE_CHUNK_CASES', 1000)),
+		'huge_tree': os.environ.get('OCA_PARSE_HUGE_TREE', '') == '1',
+		'max_rss': int(os.environ.get('OCA_PARSE_MAX_RSS', 0)) or None
+	}
+
+	etl_args = {
+		'rebuild': os.environ.get('OCA_REBUILD', '') == '1',
+		'rebuild_workers': int(os.environ.get('OCA_REBUILD_WORKERS', 4)),
+		'pipeline_depth': int(os.environ.get('OCA_PIPELINE_DEPTH', 1)),
+		'export_formats': os.environ.get('OCA_EXPORT_FORMATS', 'csv').split(','),
+		'export_workers': int(os.environ.get('OCA_EXPORT_WORKERS', 4)),
+		'snapshot_interval_days': int(os.environ.get('OCA_SNAPSHOT_INTERVAL_DAYS', 0)),
+		'fast_load': os.environ.get('OCA_FAST_LOAD', '') == '1',
+		'coalesce_incr': os.environ.get('OCA_COALESCE_INCR', '') == '1',
+		'cache_dir': os.environ.get('OCA_CACHE_DIR') or None,
+		'cache_max_bytes': int(os.environ.get('OCA_CACHE_MAX_BYTES', 20 * 1024 ** 3))
+	}
+
+	# The time, bytes and rows of each stage of the run are written to a 
+	# json file and/or a Prometheus textfile, even if the run fails
+	report_file = os.environ.get('OCA_REPORT_FILE')
+	prometheus_file = os.environ.get('OCA_PROMETHEUS_FILE')
+	report = RunReport()
+
+	try:
+		oca_etl(db_args, sftp_args, s3_args, parse_args, report=report, **etl_args)
+		report.finish('success')
+	except BaseException:
+		report.finish('failure')
+		raise
+	finally:
+		if report_file:
+			report.write_json(report_file)
+		if prometheus_file:
+			report.write_prometheus(prometheus_file)
 
 if __name__== "__main__":
 	main()
@@ -0,0 +1,28 @@
+import unittest
+
+from lib.etl import add_deltas
+
+
+class AddDeltasTest(unittest.TestCase):
+
+    def test_new_deltas_are_appended(self):
+        manifest = {'snapshot': None, 'deltas': [{'file': 'a.zip'}]}
+        add_deltas(manifest, [{'file': 'b.zip'}])
+        self.assertEqual(manifest['deltas'], [{'file': 'a.zip'}, {'file': 'b.zip'}])
+
+    def test_delta_of_reapplied_file_replaces_the_old_one(self):
+        manifest = {'snapshot': None, 'deltas': [{'file': 'a.zip'}, {'file': 'b.zip', 'created': 'old'}]}
+        add_deltas(manifest, [{'file': 'b.zip', 'created': 'new'}, {'file': 'c.zip'}])
+        self.assertEqual(manifest['deltas'], [
+            {'file': 'a.zip'}, {'file': 'b.zip', 'created': 'new'}, {'file': 'c.zip'}
+        ])
+
+    def test_coalesced_delta_replaces_deltas_of_its_files(self):
+        manifest = {'snapshot': None, 'deltas': [{'file': 'a.zip'}, {'file': 'b.zip'}]}
+        coalesced = {'file': 'c.zip', 'files': ['b.zip', 'c.zip']}
+        add_deltas(manifest, [coalesced])
+        self.assertEqual(manifest['deltas'], [{'file': 'a.zip'}, coalesced])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,31 @@
+import io
+import itertools
+import unittest
+
+from lib.database import StagingBuffer
+from lib.parsers import count_appearances, parse_chunk
+from lib.splitter import CaseSplitter
+from lib.synthetic import write_extract
+
+
+class ParseChunkTest(unittest.TestCase):
+
+    def test_chunk_past_the_buffer_thresholds(self):
+        cases = 8000
+        xml = io.BytesIO()
+        write_extract(xml, cases)
+        xml.seek(0)
+
+        splitter = CaseSplitter(xml)
+        chunk, = splitter.chunks(cases)
+        appearance_ids = list(itertools.islice(itertools.count(1), count_appearances(chunk)))
+
+        contents, parsed_cases, peak_rss = parse_chunk((splitter.wrap(chunk), appearance_ids))
+
+        self.assertGreater(sum(rows for table_name, columns, text, rows in contents), StagingBuffer(None).max_rows)
+        self.assertEqual(parsed_cases, cases)
+        self.assertGreater(peak_rss, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
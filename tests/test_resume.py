@@ -0,0 +1,144 @@
+import os
+import tempfile
+import unittest
+
+from lib.database import Database
+from lib.etl import interrupted_load, stage_file
+from lib.synthetic import write_extract_zip
+
+
+class FakeCursor:
+
+    def __init__(self, db):
+        self.db = db
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def copy_expert(self, SQL, f):
+        table_name = SQL.split()[1]
+        self.db.copied.setdefault(table_name, []).extend(f.read().splitlines())
+
+
+class FakeConnection:
+
+    def __init__(self, db):
+        self.db = db
+
+    def cursor(self):
+        return FakeCursor(self.db)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+
+class FakeDatabase(Database):
+    """
+    Just enough of a database for staging a file: it keeps the parse
+    checkpoints and ingest state, and the rows copied to each table
+    """
+
+    def __init__(self, checkpoints=None, staged_cases=0, ingest_state=None):
+        self.conn = FakeConnection(self)
+        self.checkpoints = dict(checkpoints or {})
+        self.staged_cases = staged_cases
+        self.ingest_state = dict(ingest_state or {})
+        self.sql_files = []
+        self.copied = {}
+
+    def query(self, SQL, params=None):
+        if 'FROM oca_parse_checkpoints' in SQL:
+            return [(self.checkpoints[params[0]],)] if params[0] in self.checkpoints else []
+        if 'to_regclass' in SQL:
+            return [(True,)]
+        if 'count(*)' in SQL:
+            return [(self.staged_cases,)]
+        if 'FROM oca_ingest_state' in SQL:
+            return [(self.ingest_state[params[0]],)] if params[0] in self.ingest_state else []
+        if 'nextval' in SQL:
+            start = getattr(self, 'next_id', 1)
+            self.next_id = start + params[1]
+            return [(i,) for i in range(start, self.next_id)]
+        raise AssertionError(f"Unexpected query: {SQL}")
+
+    def sql(self, SQL, params=None):
+        if SQL.startswith('DELETE FROM oca_parse_checkpoints'):
+            self.checkpoints.pop(params[0], None)
+
+    def execute(self, SQL, params=None):
+        if 'INSERT INTO oca_parse_checkpoints' in SQL:
+            self.checkpoints[params[0]] = params[1]
+
+    def execute_sql_file(self, sql_file):
+        self.sql_files.append(sql_file)
+
+    def staged_ids(self):
+        """ ids of the cases copied to the staging tables, in order """
+        rows = self.copied.get('oca_index_staging', []) + self.copied.get('oca_deletes_staging', [])
+        return sorted(row.split('\t')[0] for row in rows)
+
+
+class StageFileResumeTest(unittest.TestCase):
+
+    CASES = 60
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.zip_file = os.path.join(self.tmp_dir.name, 'LandlordTenant.Initial.FiledIn2019.zip')
+        write_extract_zip(self.zip_file, self.CASES, delete_fraction=0.1)
+        self.parse_args = {'max_rows': 50}
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_resumed_run_skips_checkpointed_cases(self):
+        full = FakeDatabase()
+        stage_file(full, self.zip_file, self.parse_args)
+        all_ids = full.staged_ids()
+        self.assertEqual(len(all_ids), self.CASES)
+
+        # An interrupted run left 25 cases in the staging tables
+        name = os.path.basename(self.zip_file)
+        resumed = FakeDatabase(checkpoints={name: 25}, staged_cases=25)
+        stage_file(resumed, self.zip_file, self.parse_args)
+
+        self.assertNotIn('create_tables_staging.sql', resumed.sql_files)
+        self.assertEqual(resumed.staged_ids(), all_ids[25:])
+        self.assertEqual(resumed.checkpoints[name], self.CASES)
+
+    def test_checkpoint_not_matching_staging_tables_starts_over(self):
+        name = os.path.basename(self.zip_file)
+        db = FakeDatabase(checkpoints={name: 25}, staged_cases=0)
+        stage_file(db, self.zip_file, self.parse_args)
+
+        self.assertIn('create_tables_staging.sql', db.sql_files)
+        self.assertEqual(len(db.staged_ids()), self.CASES)
+
+
+class InterruptedLoadTest(unittest.TestCase):
+
+    def test_interrupted_load_without_dump_is_resumed(self):
+        db = FakeDatabase(ingest_state={'from_scratch': '2020-01-01T00:00:00'})
+        self.assertTrue(interrupted_load(db, rebuild=False, dump_fingerprint=None))
+
+    def test_interrupted_rebuild_is_resumed(self):
+        db = FakeDatabase(ingest_state={'from_scratch': '2020-01-01T00:00:00'})
+        self.assertTrue(interrupted_load(db, rebuild=True, dump_fingerprint='"etag"'))
+
+    def test_dump_is_restored_instead(self):
+        db = FakeDatabase(ingest_state={'from_scratch': '2020-01-01T00:00:00'})
+        self.assertFalse(interrupted_load(db, rebuild=False, dump_fingerprint='"etag"'))
+
+    def test_finished_load_is_not_resumed(self):
+        db = FakeDatabase(ingest_state={'dump_fingerprint': '"etag"'})
+        self.assertFalse(interrupted_load(db, rebuild=True, dump_fingerprint='"etag"'))
+
+
+if __name__ == '__main__':
+    unittest.main()